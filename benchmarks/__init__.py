@@ -0,0 +1,27 @@
+"""Бенчмарки бота.
+
+Запуск из корня репозитория, например: python -m benchmarks.database
+
+    dataset  - генератор синтетических баз
+    database - замеры методов Database, результаты в JSON
+    loadtest - нагрузочный тест обработчиков с заглушкой Bot API
+    sampler  - ORDER BY RANDOM() против оконной выборки
+"""
+import importlib.util
+import logging
+import os
+import sys
+from pathlib import Path
+
+BOT_FILE = Path(__file__).resolve().parent.parent / "findteammate.1.1.1ver.py"
+
+
+def load_bot(db_path: str):
+    """Импортирует модуль бота, направив его глобальную базу в db_path"""
+    os.environ["DB_PATH"] = db_path
+    spec = importlib.util.spec_from_file_location("findteammate", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["findteammate"] = module
+    spec.loader.exec_module(module)
+    logging.getLogger("findteammate").setLevel(logging.WARNING)
+    return module
@@ -0,0 +1,156 @@
+"""Замеры методов Database на синтетической базе.
+
+    python -m benchmarks.database --users 10000 --output before.json
+    python -m benchmarks.database --users 10000 --output after.json --compare before.json
+
+Для каждого метода считаются p50/p95/p99 времени и число шагов
+виртуальной машины SQLite (через progress handler) - это приближенная
+оценка того, сколько строк просмотрел запрос.
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import load_bot
+from benchmarks.dataset import generate
+
+# Progress handler вызывается раз в столько инструкций VM
+VM_STEP_GRANULARITY = 10
+
+
+class StepCounter:
+    """Считает инструкции VM SQLite, выполненные на соединении"""
+
+    def __init__(self, conn):
+        self.steps = 0
+        conn.set_progress_handler(self._tick, VM_STEP_GRANULARITY)
+
+    def _tick(self):
+        self.steps += VM_STEP_GRANULARITY
+        return 0
+
+
+def percentile(values, pct: int) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def measure(counter: StepCounter, call, probes):
+    """Вызывает call(probe) для каждого probe и собирает статистику"""
+    timings, steps, rows = [], [], []
+    for probe in probes:
+        counter.steps = 0
+        started = time.perf_counter()
+        result = call(probe)
+        timings.append((time.perf_counter() - started) * 1000)
+        steps.append(counter.steps)
+        rows.append(len(result) if isinstance(result, (list, tuple)) else int(bool(result)))
+
+    return {
+        "calls": len(timings),
+        "p50_ms": round(percentile(timings, 50), 4),
+        "p95_ms": round(percentile(timings, 95), 4),
+        "p99_ms": round(percentile(timings, 99), 4),
+        "mean_ms": round(statistics.fmean(timings), 4),
+        "vm_steps_p50": percentile(steps, 50),
+        "vm_steps_p99": percentile(steps, 99),
+        "rows_returned_p50": percentile(rows, 50),
+    }
+
+
+def run(bot, workdir: Path, args) -> dict:
+    database = bot.Database(str(workdir / "bench.db"), profile=args.profile)
+    started = time.perf_counter()
+    dataset = generate(database, args.users, args.interactions, args.like_ratio,
+                       args.pending, args.referrals, args.seed)
+    generated_in = time.perf_counter() - started
+
+    rng = random.Random(args.seed)
+    probes = [rng.choice(dataset.verified) for _ in range(args.repeat)]
+    counter = StepCounter(database.conn)
+
+    # Записи идут последними, чтобы не менять базу под чтениями
+    cases = {
+        "find_random_teammates": lambda uid: database.find_random_teammates(uid),
+        "find_likes_for_user": lambda uid: database.find_likes_for_user(uid),
+        "get_user_interactions": lambda uid: database.get_user_interactions(uid),
+        "get_top_users_by_teamballs": lambda uid: database.get_top_users_by_teamballs(20),
+        "claim_verifications": lambda uid: database.claim_verifications(uid, 5, 0)[0],
+        "add_interaction": lambda uid: database.add_interaction(
+            uid, rng.choice(dataset.verified), rng.random() < args.like_ratio),
+    }
+
+    results = {}
+    for name, call in cases.items():
+        if args.only and name not in args.only:
+            continue
+        call(probes[0])  # Прогрев кэша страниц
+        results[name] = measure(counter, call, probes)
+
+    database.close()
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "generated_in_s": round(generated_in, 2),
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "results": results,
+    }
+
+
+def print_report(report: dict, baseline: dict = None):
+    header = f"{'method':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'vm steps':>10}"
+    if baseline:
+        header += f" {'p50 vs base':>12}"
+    print(header)
+
+    for name, row in report["results"].items():
+        line = (f"{name:<28} {row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f} "
+                f"{row['vm_steps_p50']:>10.0f}")
+        base = (baseline or {}).get("results", {}).get(name)
+        if base and base["p50_ms"]:
+            line += f" {row['p50_ms'] / base['p50_ms']:>11.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--interactions", type=int, default=20, help="свайпов на пользователя")
+    parser.add_argument("--like-ratio", type=float, default=0.5)
+    parser.add_argument("--pending", type=float, default=0.05, help="доля анкет на проверке")
+    parser.add_argument("--referrals", type=float, default=0.1, help="доля пришедших по рефссылке")
+    parser.add_argument("--repeat", type=int, default=200, help="вызовов на метод")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--profile", default="default", help="профиль PRAGMA из STORAGE_PROFILES")
+    parser.add_argument("--only", nargs="+", help="замерить только эти методы")
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON прошлого запуска для сравнения")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="db-bench-"))
+    bot = load_bot(str(workdir / "bot.db"))
+
+    report = run(bot, workdir, args)
+    baseline = json.loads(Path(args.compare).read_text(encoding="utf-8")) if args.compare else None
+    print_report(report, baseline)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Результаты сохранены в {args.output}")
+
+    bot.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Генератор синтетических баз для бенчмарков.
+
+Одинаковые параметры и seed всегда дают одинаковую базу, поэтому замеры
+разных версий бота можно сравнивать между собой.
+"""
+import random
+from datetime import datetime
+from typing import List, NamedTuple
+
+GAME_MODES = ["BedWars", "Murder Mystery 2", "Tower of Hell", "Adopt Me", "Blox Fruits", "Doors", "Arsenal"]
+
+
+class Dataset(NamedTuple):
+    """Идентификаторы созданных пользователей по группам"""
+    verified: List[int]
+    pending: List[int]
+    referred: List[int]
+
+
+def generate(database, users: int, interactions_per_user: int = 20, like_ratio: float = 0.5,
+             pending_ratio: float = 0.05, referral_ratio: float = 0.1, seed: int = 1,
+             clusters: int = 0) -> Dataset:
+    """Заполняет пустую базу Database и возвращает идентификаторы пользователей
+
+    pending_ratio - доля анкет на проверке, referral_ratio - доля
+    пользователей, пришедших по реферальной ссылке. Свайпы делают только
+    одобренные анкеты и только по одобренным, как в боте. clusters > 0
+    раскладывает user_id по стольким плотным группам с большими
+    промежутками между ними, как у настоящих Telegram ID; 0 - равномерно.
+    """
+    rng = random.Random(seed)
+    started = int(datetime(2025, 1, 1).timestamp())
+    if clusters:
+        step = 6_000_000_000 // max(clusters - 1, 1)
+        per_cluster = -(-users // clusters)
+        ids = [uid for n in range(clusters)
+               for uid in rng.sample(range(1_000_000_000 + n * step, 1_000_000_000 + n * step + users * 10),
+                                     per_cluster)][:users]
+    else:
+        ids = rng.sample(range(10_000_000, 8_000_000_000), users)
+    pending = set(rng.sample(ids, int(users * pending_ratio)))
+    verified = [uid for uid in ids if uid not in pending]
+
+    def timestamp() -> int:
+        return started + rng.randrange(90 * 24 * 3600)
+
+    cursor = database.conn.cursor()
+    cursor.executemany('''
+        INSERT INTO users (user_id, username, roblox_nickname, game_modes, profile_verified,
+                           team_balls, is_banned, referral_code, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', ((uid, f"user{uid}", f"nick{uid}", ", ".join(rng.sample(GAME_MODES, rng.randint(1, 3))),
+           0 if uid in pending else 1, rng.randrange(0, 5000), 1 if rng.random() < 0.02 else 0,
+           f"r{uid}", timestamp()) for uid in ids))
+
+    if pending:
+        cursor.executemany('INSERT OR IGNORE INTO verification_queue (user_id, submitted_at) VALUES (?, ?)',
+                           ((uid, n) for n, uid in enumerate(sorted(pending))))
+
+    def swipes():
+        for from_user_id in verified:
+            for to_user_id in rng.sample(verified, min(interactions_per_user, len(verified))):
+                if to_user_id != from_user_id:
+                    yield from_user_id, to_user_id, 1 if rng.random() < like_ratio else 0, '', timestamp()
+
+    cursor.executemany('''
+        INSERT OR IGNORE INTO interactions (from_user_id, to_user_id, is_like, message, sent_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', swipes())
+
+    referred = rng.sample(ids, int(users * referral_ratio))
+    referrals = [(rng.choice(ids), uid, 1 if rng.random() < 0.3 else 0, timestamp()) for uid in referred]
+    cursor.executemany('''
+        INSERT INTO referrals (referrer_id, referred_id, completed, created_at) VALUES (?, ?, ?, ?)
+    ''', (row for row in referrals if row[0] != row[1]))
+    cursor.executemany('UPDATE users SET referred_by = ? WHERE user_id = ?',
+                       ((referrer_id, referred_id) for referrer_id, referred_id, _, _ in referrals))
+    database.conn.commit()
+
+    # Счетчики, итоги и теги режимов, которые бот ведет сам, пересчитываем по готовым таблицам
+    database.repair_counters()
+    database.rebuild_user_modes()
+    database.reconcile_stats()
+    database.conn.execute('ANALYZE')
+    database.conn.commit()
+    return Dataset(verified, sorted(pending), referred)
@@ -0,0 +1,297 @@
+"""Нагрузочный тест всех обработчиков бота без сети.
+
+    python -m benchmarks.loadtest --users 1000 --concurrency 1 16 64 --output load.json
+
+Bot API подменяется FakeBotAPI: запросы не уходят в сеть, а записываются.
+Симулированные пользователи создают анкеты, листают колоду (лайки и
+дизлайки по кнопкам из последней карточки) и покупают промокоды. Апдейты
+одного пользователя идут по порядку, разные пользователи - параллельно,
+не больше concurrency одновременно.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from benchmarks import load_bot
+from benchmarks.database import percentile
+
+# Счетчик вызовов API текущего апдейта. Задачи, созданные обработчиком
+# (рассылки), наследуют контекст, поэтому их вызовы тоже засчитываются ему
+current_update = contextvars.ContextVar("current_update", default=None)
+
+
+class FakeBotAPI(BaseRequest):
+    """Слой запросов, который отвечает на все методы Bot API локально"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.last_markup = {}
+        self.last_message = {}
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+
+        counter = current_update.get()
+        if counter is not None:
+            counter[name] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id")
+        if chat_id is not None and "reply_markup" in params:
+            self.last_markup[chat_id] = params["reply_markup"]
+
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "loadtest_bot"}
+        elif name.startswith(("send", "edit")):
+            result = {"message_id": params.get("message_id") or next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id or 1, "type": "private"}}
+            if name in ("sendPhoto", "editMessageMedia"):
+                result["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}]
+            else:
+                result["text"] = params.get("text", "")
+            # Кнопки нажимают на последнем сообщении с inline-клавиатурой
+            if chat_id is not None and "reply_markup" in params and "inline_keyboard" in params["reply_markup"]:
+                self.last_message[chat_id] = result
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class UpdateFactory:
+    """Собирает апдейты в формате Bot API от имени пользователя"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+    def _message(self, user_id: int, text: str = None, photo: bool = False) -> dict:
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            message["photo"] = [{"file_id": f"skin{user_id}", "file_unique_id": f"skin{user_id}",
+                                 "width": 512, "height": 512}]
+        return message
+
+    def message(self, user_id: int, text: str = None, photo: bool = False) -> dict:
+        return {"update_id": next(self._ids), "message": self._message(user_id, text, photo)}
+
+    def callback(self, user_id: int, data: str, message: dict = None) -> dict:
+        """Нажатие кнопки; message - сообщение с кнопкой, по умолчанию текстовое"""
+        if message is None:
+            message = self._message(user_id, "menu")
+        else:
+            message = {**message, "from": {**self._user(1), "is_bot": True}}
+        return {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "chat_instance": "load", "from": self._user(user_id),
+            "message": message, "data": data}}
+
+
+class LoadTest:
+    """Прогон сценария на одном экземпляре бота"""
+
+    def __init__(self, bot, api: FakeBotAPI, args):
+        self.bot = bot
+        self.api = api
+        self.args = args
+        self.updates = UpdateFactory()
+        self.latency = defaultdict(list)
+        self.api_calls = defaultdict(list)
+        self.app = None
+
+    def handler_name(self, update: dict) -> str:
+        if "callback_query" in update:
+            route, _ = self.bot.router.resolve(update["callback_query"]["data"])
+            return f"callback:{route.name if route else 'unknown'}"
+        message = update["message"]
+        if "photo" in message:
+            return "photo_handler"
+        if message["text"].startswith("/"):
+            return message["text"].split()[0]
+        return "message_handler"
+
+    async def send(self, update: dict):
+        counter = Counter()
+        token = current_update.set(counter)
+        started = time.perf_counter()
+        try:
+            await self.app.process_update(Update.de_json(update, self.app.bot))
+        finally:
+            current_update.reset(token)
+        name = self.handler_name(update)
+        self.latency[name].append((time.perf_counter() - started) * 1000)
+        self.api_calls[name].append(counter)
+
+    def card_buttons(self, user_id: int):
+        """Кнопки лайка и дизлайка из последней карточки, показанной пользователю"""
+        markup = self.api.last_markup.get(user_id) or {}
+        data = [button.get("callback_data", "") for row in markup.get("inline_keyboard", []) for button in row]
+        return [item for item in data if item.startswith(("like_", "dislike_"))]
+
+    async def create_profile(self, user_id: int):
+        await self.send(self.updates.message(user_id, "/start"))
+        await self.send(self.updates.callback(user_id, "my_profile"))
+        await self.send(self.updates.message(user_id, f"Load{user_id}"))
+        await self.send(self.updates.message(user_id, photo=True))
+        await self.send(self.updates.message(user_id, "BedWars, Murder Mystery 2"))
+
+    async def swipe_and_shop(self, user_id: int, rng: random.Random):
+        await self.send(self.updates.callback(user_id, "find_teammate"))
+        for _ in range(self.args.swipes):
+            buttons = self.card_buttons(user_id)
+            if not buttons:
+                break
+            like = rng.random() < self.args.like_ratio
+            choice = next((data for data in buttons if data.startswith("like_" if like else "dislike_")), buttons[0])
+            await self.send(self.updates.callback(user_id, choice, self.api.last_message.get(user_id)))
+
+        if rng.random() < self.args.buy_ratio:
+            await self.send(self.updates.callback(user_id, "shop"))
+            await self.send(self.updates.callback(user_id, "buy_100"))
+        await self.send(self.updates.callback(user_id, "my_profile"))
+
+    async def run_phase(self, scenario, user_ids, concurrency: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(user_id):
+            async with semaphore:
+                await scenario(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(user_id) for user_id in user_ids))
+        return time.perf_counter() - started
+
+    async def run(self, concurrency: int) -> dict:
+        self.app = self.bot.build_application("1:loadtest", request=self.api)
+        user_ids = list(range(100_000, 100_000 + self.args.users))
+        rngs = {user_id: random.Random(self.args.seed * 1_000_003 + user_id) for user_id in user_ids}
+
+        async with self.app:
+            await self.app.post_init(self.app)
+            await self.app.start()
+            # Служебные задачи приложения, их drain не трогает
+            internal = asyncio.all_tasks()
+
+            profiles_s = await self.run_phase(self.create_profile, user_ids, concurrency)
+            # Модерация вне замера: одобряем анкеты и выдаем тимбалы на покупки
+            for user_id in user_ids:
+                await self.bot.db.approve_profile(user_id)
+                await self.bot.db.add_team_balls(user_id, self.bot.PROMO_CODES["100"])
+            swipes_s = await self.run_phase(lambda uid: self.swipe_and_shop(uid, rngs[uid]), user_ids, concurrency)
+
+            await self.drain(internal)
+            await self.app.stop()
+        await self.app.post_shutdown(self.app)
+        return self.report(concurrency, profiles_s, swipes_s)
+
+    async def drain(self, internal):
+        """Дожидается фоновых рассылок, но не дольше --drain секунд"""
+        pending = asyncio.all_tasks() - internal
+        if pending:
+            _, still_running = await asyncio.wait(pending, timeout=self.args.drain)
+            for task in still_running:
+                task.cancel()
+
+    def report(self, concurrency: int, profiles_s: float, swipes_s: float) -> dict:
+        handlers = {}
+        for name, timings in sorted(self.latency.items()):
+            calls = [sum(counter.values()) for counter in self.api_calls[name]]
+            methods = sum(self.api_calls[name], Counter())
+            handlers[name] = {
+                "updates": len(timings),
+                "p50_ms": round(percentile(timings, 50), 3),
+                "p95_ms": round(percentile(timings, 95), 3),
+                "p99_ms": round(percentile(timings, 99), 3),
+                "api_calls_per_update": round(statistics.fmean(calls), 2),
+                "api_methods": dict(methods.most_common()),
+            }
+
+        total_updates = sum(len(timings) for timings in self.latency.values())
+        total_s = profiles_s + swipes_s
+        return {
+            "concurrency": concurrency,
+            "updates": total_updates,
+            "seconds": round(total_s, 3),
+            "updates_per_second": round(total_updates / total_s, 1) if total_s else 0.0,
+            "api_calls": sum(self.api.calls.values()),
+            "api_calls_per_update": round(sum(self.api.calls.values()) / total_updates, 2),
+            "phases": {"profiles_s": round(profiles_s, 3), "swipes_s": round(swipes_s, 3)},
+            "handlers": handlers,
+        }
+
+
+def print_report(run: dict):
+    print(f"\nconcurrency={run['concurrency']}: {run['updates']} апдейтов за {run['seconds']} с, "
+          f"{run['updates_per_second']} апд/с, {run['api_calls_per_update']} вызовов API на апдейт")
+    print(f"{'handler':<28} {'updates':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'api/upd':>8}")
+    for name, row in run["handlers"].items():
+        print(f"{name:<28} {row['updates']:>8} {row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} "
+              f"{row['p99_ms']:>9.3f} {row['api_calls_per_update']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500, help="симулированных пользователей")
+    parser.add_argument("--swipes", type=int, default=20, help="свайпов на пользователя")
+    parser.add_argument("--like-ratio", type=float, default=0.5)
+    parser.add_argument("--buy-ratio", type=float, default=0.2, help="доля пользователей, покупающих промокод")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--drain", type=float, default=2.0, help="сколько ждать фоновые рассылки, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+    runs = []
+    for concurrency in args.concurrency:
+        # Для каждого уровня параллелизма - свежая база и свежий модуль бота
+        workdir = Path(tempfile.mkdtemp(prefix="loadtest-"))
+        bot = load_bot(str(workdir / "bot.db"))
+        api = FakeBotAPI(args.api_latency / 1000)
+        result = asyncio.run(LoadTest(bot, api, args).run(concurrency))
+        print_report(result)
+        runs.append(result)
+
+    if args.output:
+        report = {"params": {key: value for key, value in vars(args).items() if key != "output"}, "runs": runs}
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nРезультаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Сравнение ORDER BY RANDOM() и оконной выборки find_random_teammates.
+
+    python -m benchmarks.sampler --sizes 1000 10000 100000
+
+Каждый размер замеряется на равномерных user_id и на двух плотных группах
+ID с большим промежутком (как у настоящих Telegram ID). Колонка coverage -
+сколько разных анкет выдала выборка за --coverage-calls вызовов для
+одного пользователя из числа одобренных. Колонка modes - доля карточек
+самого редкого режима среди общих для пользователя с несколькими режимами:
+при равном подборе около 1/N, 0% - какой-то режим не выдается вовсе.
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import load_bot
+from benchmarks.dataset import generate
+
+# Исходный запрос: анти-джойн для каждой анкеты и сортировка всей выборки
+LEGACY_QUERY = '''
+    SELECT u.*
+    FROM users u
+    WHERE u.user_id != ?
+    AND u.profile_verified = 1
+    AND u.is_banned = 0
+    AND NOT EXISTS (
+        SELECT 1 FROM interactions i
+        WHERE (i.from_user_id = ? AND i.to_user_id = u.user_id)
+        OR (i.from_user_id = u.user_id AND i.to_user_id = ? AND i.is_like = 1)
+    )
+    ORDER BY RANDOM()
+    LIMIT 10
+'''
+
+
+def measure(func, user_ids, repeat: int):
+    timings = []
+    for user_id in user_ids[:repeat]:
+        started = time.perf_counter()
+        func(user_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def coverage(database, user_id: int, calls: int) -> int:
+    """Число разных анкет, выданных find_random_teammates за calls вызовов"""
+    seen = set()
+    for _ in range(calls):
+        seen.update(candidate.user_id for candidate in database.find_random_teammates(user_id))
+    return len(seen)
+
+
+def mode_balance(database, user_id: int, calls: int) -> float:
+    """Доля карточек самого редкого из режимов user_id за calls вызовов"""
+    modes = [mode for (mode,) in database.conn.execute(
+        'SELECT mode FROM user_modes WHERE user_id = ?', (user_id,))]
+    cards = dict.fromkeys(modes, 0)
+    for _ in range(calls):
+        for candidate in database.find_random_teammates(user_id):
+            for mode in modes:
+                if mode in (candidate.game_modes or ''):
+                    cards[mode] += 1
+    total = sum(cards.values())
+    return min(cards.values()) / total if total else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--swipes", type=int, default=5, help="свайпов на пользователя")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--coverage-calls", type=int, default=2000, help="вызовов для подсчета coverage")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="sampler-bench-"))
+    bot = load_bot(str(workdir / "bot.db"))
+
+    print(f"{'users':>8} {'ids':>9} | {'legacy p50':>10} {'max':>8} | {'sampler p50':>11} {'max':>8} | "
+          f"{'coverage':>13} {'modes':>5}")
+    for size in args.sizes:
+        for layout, clusters in (("uniform", 0), ("clustered", 2)):
+            database = bot.Database(str(workdir / f"users-{size}-{layout}.db"))
+            ids = generate(database, size, args.swipes, pending_ratio=0, referral_ratio=0, seed=args.seed,
+                           clusters=clusters).verified
+            probe = random.Random(args.seed).sample(ids, min(args.repeat, len(ids)))
+
+            def legacy(user_id):
+                return database.conn.execute(LEGACY_QUERY, (user_id, user_id, user_id)).fetchall()
+
+            legacy_p50, legacy_max = measure(legacy, probe, args.repeat)
+            sampler_p50, sampler_max = measure(database.find_random_teammates, probe, args.repeat)
+            covered = coverage(database, probe[0], args.coverage_calls)
+            multi = next(user_id for (user_id,) in database.conn.execute(
+                'SELECT user_id FROM user_modes GROUP BY user_id HAVING COUNT(*) > 1'))
+            balance = mode_balance(database, multi, args.coverage_calls)
+            print(f"{size:>8} {layout:>9} | {legacy_p50:>8.2f}ms {legacy_max:>6.2f}ms | "
+                  f"{sampler_p50:>9.2f}ms {sampler_max:>6.2f}ms | {covered:>6}/{len(ids):<6} {balance:>5.0%}")
+            database.close()
+
+    bot.db.close()
+
+
+if __name__ == "__main__":
+    main()
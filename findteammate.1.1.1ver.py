@@ -1,22 +1,128 @@
 import os
+import asyncio
+import atexit
+import bisect
+import functools
+import itertools
+import json
 import logging
+import queue
+import random
+import re
 import sqlite3
+import sys
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto
+)
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 
 # Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Частые события пишутся не все: из каждых N записей категории остается одна
+LOG_SAMPLE_RATES = {
+    "button": 100,  # Нажатия кнопок
+    "swipe": 20,  # Матчи и кулдауны после лайков
+    "balance": 10,  # Изменения баланса тимбалов
+}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Строка вида 2025-01-01 12:00:00,000 level=INFO logger=x msg="..." key=value"""
+
+    @staticmethod
+    def _value(value) -> str:
+        text = str(value)
+        if not text or any(char in text for char in ' ="\n'):
+            return json.dumps(text, ensure_ascii=False)
+        return text
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [self.formatTime(record), f"level={record.levelname}", f"logger={record.name}",
+                 f"msg={self._value(record.getMessage())}"]
+        category = getattr(record, "category", None)
+        if category:
+            parts.append(f"category={category}")
+        for key, value in getattr(record, "fields", {}).items():
+            parts.append(f"{key}={self._value(value)}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает одну запись из rates[category], остальные отбрасывает"""
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = rates
+        self._seen = {category: itertools.count() for category in rates}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, "category", None)
+        rate = self.rates.get(category, 1)
+        if rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        if next(self._seen[category]) % rate:
+            return False
+        record.fields = {**getattr(record, "fields", {}), "sample": f"1/{rate}"}
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладет запись в очередь как есть: текст собирается в потоке QueueListener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    """Направляет логи через очередь в отдельный поток и возвращает его слушателя
+
+    Обработчики событий только кладут запись в очередь, форматирование
+    и вывод в терминал идут в потоке QueueListener.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+
+    stream = logging.StreamHandler()
+    stream.setFormatter(KeyValueFormatter())
+    listener = QueueListener(log_queue, stream, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # httpx пишет строку на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def log_event(category: str, msg: str, *args, level: int = logging.INFO, **fields):
+    """Пишет запись с категорией для выборки и полями key=value"""
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={"category": category, "fields": fields})
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # =========== НАСТРОЙКИ БОТА ===========
@@ -32,12 +138,86 @@ VERIFIER_IDS = [1719251644]  # ← ID модераторов
 ADMIN_AND_VERIFIER_IDS = [1719251644]  # ← ID тех, кто имеет обе роли
 # ======================================
 
+# Режим работы: если задан WEBHOOK_URL - webhook, иначе polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+
+# Параллельная обработка: разные пользователи - одновременно, один - по очереди
+MAX_CONCURRENT_UPDATES = 64
+
 # Настройки тимбалов
 TEAMBALLS_PER_MATCH = 5
 TEAMBALLS_PER_REFERRAL = 12
 REFERRAL_MATCHES_REQUIRED = 2
 MATCH_COOLDOWN_HOURS = 1
 
+# Настройки базы данных
+DB_PATH = os.getenv("DB_PATH", "teammates_bot.db")
+DB_READER_THREADS = 4  # Потоков для чтения (у каждого свое соединение)
+DB_PROFILE = os.getenv("DB_PROFILE", "default")  # Профиль из STORAGE_PROFILES
+
+# Профили настроек SQLite. В режиме WAL читатели не блокируют писателя.
+STORAGE_PROFILES = {
+    # fsync на каждый коммит - ни одна подтвержденная транзакция не теряется
+    "durable": {
+        "journal_mode": "WAL", "synchronous": "FULL",
+        "cache_size": -16000, "mmap_size": 0, "busy_timeout": 5000,
+    },
+    # fsync только при чекпоинтах - при сбое питания могут потеряться
+    # последние транзакции, но база остается целой
+    "default": {
+        "journal_mode": "WAL", "synchronous": "NORMAL",
+        "cache_size": -64000, "mmap_size": 256 * 1024 * 1024, "busy_timeout": 5000,
+    },
+    # Без fsync, для бенчмарков и нагрузочных тестов
+    "fast": {
+        "journal_mode": "WAL", "synchronous": "OFF",
+        "cache_size": -256000, "mmap_size": 1024 * 1024 * 1024, "busy_timeout": 5000,
+    },
+}
+
+# Отложенная запись свайпов: копятся в памяти и пишутся пачками
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_INTERVAL = 0.005  # Секунд ожидания перед записью пачки
+WRITE_BEHIND_BATCH_SIZE = 200  # Записать сразу, если набралось столько
+
+# Выборка случайных анкет
+SAMPLER_WINDOW_SIZE = 40  # Анкет пула в одном окне
+SAMPLER_MAX_WINDOWS = 4  # Окон до перехода к полному просмотру
+SAMPLER_MAX_MODES = 5  # Сколько режимов анкеты учитывать при подборе
+SAMPLER_MODE_WINDOWS = 2  # Окон на каждый режим
+
+# Состояния диалогов (создание анкеты, поддержка)
+STATE_TTL_SECONDS = 30 * 60  # Брошенный диалог забывается через 30 минут
+STATE_MAX_ENTRIES = 50_000  # Сверх лимита вытесняются самые старые
+STATE_PERSIST = os.getenv("STATE_PERSIST", "1") == "1"  # Сохранять в базу
+STATE_STATS_SAMPLE = 32  # Записей для оценки памяти в /stats
+
+# Сверка итогов /stats с таблицами (нужен python-telegram-bot[job-queue])
+STATS_RECONCILE_INTERVAL = 60 * 60
+
+# Очередь проверки анкет: размер пачки и время аренды
+VERIFICATION_BATCH_SIZE = 5
+VERIFICATION_LEASE_SECONDS = 15 * 60
+
+# Размер страницы /users
+USERS_PAGE_SIZE = 30
+
+# Кэш карточек тиммейтов
+CARD_CACHE_MAX_ENTRIES = 20_000
+
+# Уведомления админам и верификаторам
+NOTIFY_MAX_CONCURRENCY = 8  # Одновременных отправок в одной рассылке
+NOTIFY_RATE_PER_SECOND = 25  # Общий лимит Telegram - около 30 сообщений в секунду
+NOTIFY_PER_CHAT_INTERVAL = 1.0  # Секунд между сообщениями в один чат
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - выключить)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
 # Промокоды
 PROMO_CODES = {
     "100": 1000,
@@ -49,13 +229,494 @@ PROMO_CODES = {
     "5000": 39000
 }
 
+class Candidate(NamedTuple):
+    """Анкета в колоде поиска тиммейтов"""
+    user_id: int
+    roblox_nickname: str
+    game_modes: str
+    photo_id: Optional[str]
+    matches_found: int
+
+
+class Metrics:
+    """Счетчики и гистограммы в формате Prometheus
+
+    Значения обновляются и из event loop, и из потоков базы, поэтому все
+    изменения идут под одной блокировкой. Метки передаются keyword-аргументами.
+    Датчики (gauge) не хранятся, а вычисляются функцией при каждом опросе.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
 
-class Database:
     def __init__(self):
-        self.conn = sqlite3.connect('teammates_bot.db', check_same_thread=False)
-        self.create_tables()
+        self._lock = threading.Lock()
+        self._help: Dict[str, tuple] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, list] = {}
+        self._gauges: Dict[str, object] = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Счетчики по корзинам, затем сумма и количество
+                histogram = self._histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            index = bisect.bisect_left(self.BUCKETS, seconds)
+            if index < len(self.BUCKETS):
+                histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def gauge(self, name: str, text: str, func):
+        self.describe(name, "gauge", text)
+        self._gauges[name] = func
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render(self) -> str:
+        """Текст для /metrics"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+
+        described = set()
+
+        def header(name: str):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        for (name, pairs), value in counters:
+            header(name)
+            lines.append(f"{name}{self._labels(pairs)} {value}")
+
+        for (name, pairs), histogram in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(pairs + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(pairs + (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{name}_sum{self._labels(pairs)} {histogram[-2]}")
+            lines.append(f"{name}_count{self._labels(pairs)} {histogram[-1]}")
+
+        for name, func in self._gauges.items():
+            header(name)
+            try:
+                lines.append(f"{name} {func()}")
+            except Exception as e:
+                logger.error("Ошибка датчика %s: %s", name, e)
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Время обработки апдейта по обработчикам")
+metrics.describe("bot_handler_errors_total", "counter", "Исключения в обработчиках")
+metrics.describe("bot_db_seconds", "histogram", "Время выполнения методов Database в потоке базы")
+metrics.describe("bot_api_requests_total", "counter", "Запросы к Bot API по методу и результату")
+metrics.describe("bot_api_seconds", "histogram", "Время запросов к Bot API")
+metrics.describe("bot_deck_exhausted_total", "counter", "Поиск тиммейтов закончился без анкет")
+
+
+# Режимы игр: каноническое название -> варианты написания (после casefold)
+GAME_MODE_ALIASES = {
+    "BedWars": ["bedwars", "bed wars", "bw", "бедварс", "бед варс"],
+    "Murder Mystery 2": ["murder mystery 2", "murder mystery", "mm2", "мм2", "мардер мистери"],
+    "Tower of Hell": ["tower of hell", "toh", "товер оф хелл"],
+    "Adopt Me": ["adopt me", "adopt me!", "адопт ми"],
+    "Blox Fruits": ["blox fruits", "bloxfruits", "bf", "блокс фрутс"],
+    "Doors": ["doors", "дорс"],
+    "Arsenal": ["arsenal", "арсенал"],
+    "Brookhaven": ["brookhaven", "brookhaven rp", "брукхейвен"],
+    "Jailbreak": ["jailbreak", "jail break", "джейлбрейк"],
+    "Natural Disaster Survival": ["natural disaster survival", "nds"],
+}
+GAME_MODE_LOOKUP = {alias: mode for mode, aliases in GAME_MODE_ALIASES.items()
+                    for alias in [mode.casefold(), *aliases]}
+GAME_MODE_SEPARATORS = re.compile(r"[,;/|\n+]+|\s+(?:и|and)\s+")
+GAME_MODE_MAX_TAGS = 10
+GAME_MODE_MAX_LENGTH = 40
+
+
+def parse_game_modes(text: Optional[str]) -> List[str]:
+    """Разбирает свободный текст режимов в список тегов без повторов
+
+    Известные режимы приводятся к каноническому названию, остальные - к
+    нижнему регистру с одиночными пробелами, чтобы одинаково написанные
+    незнакомые режимы тоже совпадали.
+    """
+    tags = []
+    for part in GAME_MODE_SEPARATORS.split(text or ""):
+        key = " ".join(part.casefold().strip(" .!?-\"'").split())
+        if not key or len(key) > GAME_MODE_MAX_LENGTH:
+            continue
+        tag = GAME_MODE_LOOKUP.get(key, key)
+        if tag not in tags:
+            tags.append(tag)
+    return tags[:GAME_MODE_MAX_TAGS]
+
+
+def fill_user_modes(cursor):
+    """Заполняет user_modes заново по тексту users.game_modes"""
+    cursor.execute('DELETE FROM user_modes')
+    cursor.execute('SELECT user_id, game_modes FROM users WHERE game_modes IS NOT NULL')
+    rows = [(mode, user_id) for user_id, text in cursor.fetchall() for mode in parse_game_modes(text)]
+    cursor.executemany('INSERT OR IGNORE INTO user_modes (mode, user_id) VALUES (?, ?)', rows)
+
+
+# Столбцы времени, которые миграция 10 переводит из ISO-строк в секунды Unix
+TIMESTAMP_COLUMNS = {
+    "users": ("last_match_time", "created_at"),
+    "interactions": ("sent_at",),
+    "referrals": ("created_at",),
+    "purchases": ("purchased_at",),
+    "support_messages": ("created_at",),
+}
+
+# Столбцы, куда писалось дробное time.time(); миграция 13 переводит их
+# в целые секунды, как остальные
+FLOAT_TIMESTAMP_COLUMNS = {
+    "verification_queue": ("submitted_at", "lease_expires_at"),
+    "user_states": ("expires_at",),
+}
+
+
+def iso_to_epoch(value) -> Optional[int]:
+    """ISO-8601 из прежних версий бота в секунды Unix
+
+    Старые значения писались datetime.now() без пояса, поэтому читаются
+    как местное время. Нечитаемые значения становятся NULL.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return None
+
+
+def rebuild_table(cursor, table: str, retype: Dict[str, str], convert: str = None):
+    """Пересоздает таблицу, меняя типы столбцов (ALTER TABLE в SQLite этого не умеет)
+
+    Новое определение берется из sqlite_master с заменой типов из retype,
+    данные копируются с функцией convert для этих столбцов, индексы и
+    триггеры таблицы создаются заново.
+    """
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    create_sql = cursor.fetchone()[0]
+    cursor.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+                   "AND sql IS NOT NULL", (table,))
+    dependents = [row[0] for row in cursor.fetchall()]
+    cursor.execute(f'PRAGMA table_info({table})')
+    columns = [row[1] for row in cursor.fetchall()]
+
+    create_sql = re.sub(rf'^CREATE TABLE "?{table}"?', f'CREATE TABLE {table}_new', create_sql)
+    for column, new_type in retype.items():
+        create_sql = re.sub(rf'\b{column}\s+\w+', f'{column} {new_type}', create_sql, count=1)
+    select = ", ".join(f"{convert}({column})" if convert and column in retype else column for column in columns)
+
+    cursor.execute(create_sql)
+    cursor.execute(f'INSERT INTO {table}_new ({", ".join(columns)}) SELECT {select} FROM {table}')
+    cursor.execute(f'DROP TABLE {table}')
+    cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    for sql in dependents:
+        cursor.execute(sql)
+
+
+def convert_timestamps_to_epoch(cursor, columns: Dict[str, tuple] = TIMESTAMP_COLUMNS):
+    """Переводит столбцы columns ({таблица: столбцы}) в INTEGER с секундами Unix"""
+    cursor.connection.create_function("iso_to_epoch", 1, iso_to_epoch, deterministic=True)
+    for table, names in columns.items():
+        rebuild_table(cursor, table, {name: "INTEGER" for name in names}, "iso_to_epoch")
+
+
+# Пересчет счетчиков users из исходных таблиц (миграция и команда /recount)
+COUNTERS_REPAIR_SQL = '''
+    UPDATE users SET
+        likes_received = (
+            SELECT COUNT(*) FROM interactions i WHERE i.to_user_id = users.user_id AND i.is_like = 1
+        ),
+        referrals_completed = (
+            SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = users.user_id AND r.completed = 1
+        )
+    WHERE likes_received IS NOT (
+            SELECT COUNT(*) FROM interactions i WHERE i.to_user_id = users.user_id AND i.is_like = 1
+        )
+        OR referrals_completed IS NOT (
+            SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = users.user_id AND r.completed = 1
+        )
+'''
+
+# Флаг незавершенного реферала по таблице referrals (миграция и команда /recount)
+REFERRAL_PENDING_REPAIR_SQL = '''
+    UPDATE users SET referral_pending = 1 - referral_pending
+    WHERE referral_pending != EXISTS (
+        SELECT 1 FROM referrals r WHERE r.referred_id = users.user_id AND r.completed = 0
+    )
+'''
+
+# Итоги для /stats, посчитанные по исходным таблицам: строки (name, value)
+STATS_TOTALS_SQL = '''
+    SELECT 'total_users', COUNT(*) FROM users
+    UNION ALL SELECT 'verified_users', COUNT(*) FROM users WHERE profile_verified = 1
+    UNION ALL SELECT 'pending_users', COUNT(*) FROM users WHERE profile_verified = 0 AND roblox_nickname IS NOT NULL
+    UNION ALL SELECT 'banned_users', COUNT(*) FROM users WHERE is_banned = 1
+    UNION ALL SELECT 'total_likes', COUNT(*) FROM interactions WHERE is_like = 1
+    UNION ALL SELECT 'total_teamballs', IFNULL(SUM(team_balls), 0) FROM users
+'''
+
+# Миграции схемы: (версия, список SQL-запросов или функций от курсора).
+# Текущая версия хранится в PRAGMA user_version, при запуске применяются
+# только новые миграции.
+# users.referral_code уже проиндексирован через UNIQUE.
+MIGRATIONS = [
+    (1, [
+        'CREATE INDEX IF NOT EXISTS idx_interactions_from_to ON interactions (from_user_id, to_user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_interactions_to_like ON interactions (to_user_id, is_like, sent_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)',
+        'CREATE INDEX IF NOT EXISTS idx_users_verified_banned ON users (profile_verified, is_banned)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id, completed)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id, completed)',
+    ]),
+    # Одна оценка на пару пользователей: убираем дубли и делаем индекс уникальным
+    (2, [
+        '''DELETE FROM interactions WHERE interaction_id NOT IN (
+            SELECT MIN(interaction_id) FROM interactions GROUP BY from_user_id, to_user_id
+        )''',
+        'DROP INDEX IF EXISTS idx_interactions_from_to',
+        'CREATE UNIQUE INDEX idx_interactions_from_to ON interactions (from_user_id, to_user_id)',
+    ]),
+    # Состояния незавершенных диалогов
+    (3, [
+        '''CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT,
+            expires_at REAL
+        )''',
+    ]),
+    # Счетчики полученных лайков и выполненных рефералов, чтобы не считать их COUNT(*)
+    (4, [
+        'ALTER TABLE users ADD COLUMN likes_received INTEGER DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN referrals_completed INTEGER DEFAULT 0',
+        COUNTERS_REPAIR_SQL,
+    ]),
+    # Итоги для /stats, которые поддерживают триггеры на users и interactions
+    (5, [
+        '''CREATE TABLE IF NOT EXISTS bot_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        'INSERT OR REPLACE INTO bot_stats (name, value) ' + STATS_TOTALS_SQL,
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE bot_stats SET value = value + CASE name
+                WHEN 'total_users' THEN 1
+                WHEN 'verified_users' THEN NEW.profile_verified IS 1
+                WHEN 'pending_users' THEN NEW.profile_verified IS 0 AND NEW.roblox_nickname IS NOT NULL
+                WHEN 'banned_users' THEN NEW.is_banned IS 1
+                WHEN 'total_teamballs' THEN IFNULL(NEW.team_balls, 0)
+                ELSE 0 END;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE bot_stats SET value = value - CASE name
+                WHEN 'total_users' THEN 1
+                WHEN 'verified_users' THEN OLD.profile_verified IS 1
+                WHEN 'pending_users' THEN OLD.profile_verified IS 0 AND OLD.roblox_nickname IS NOT NULL
+                WHEN 'banned_users' THEN OLD.is_banned IS 1
+                WHEN 'total_teamballs' THEN IFNULL(OLD.team_balls, 0)
+                ELSE 0 END;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_users_status
+        AFTER UPDATE OF profile_verified, is_banned, roblox_nickname ON users
+        WHEN NEW.profile_verified IS NOT OLD.profile_verified OR NEW.is_banned IS NOT OLD.is_banned
+            OR (NEW.roblox_nickname IS NULL) != (OLD.roblox_nickname IS NULL)
+        BEGIN
+            UPDATE bot_stats SET value = value + CASE name
+                WHEN 'verified_users' THEN (NEW.profile_verified IS 1) - (OLD.profile_verified IS 1)
+                WHEN 'pending_users' THEN
+                    (NEW.profile_verified IS 0 AND NEW.roblox_nickname IS NOT NULL)
+                    - (OLD.profile_verified IS 0 AND OLD.roblox_nickname IS NOT NULL)
+                WHEN 'banned_users' THEN (NEW.is_banned IS 1) - (OLD.is_banned IS 1)
+                END
+            WHERE name IN ('verified_users', 'pending_users', 'banned_users');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_users_balls AFTER UPDATE OF team_balls ON users
+        WHEN NEW.team_balls IS NOT OLD.team_balls
+        BEGIN
+            UPDATE bot_stats SET value = value + IFNULL(NEW.team_balls, 0) - IFNULL(OLD.team_balls, 0)
+            WHERE name = 'total_teamballs';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_likes_insert AFTER INSERT ON interactions
+        WHEN NEW.is_like = 1
+        BEGIN
+            UPDATE bot_stats SET value = value + 1 WHERE name = 'total_likes';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_likes_delete AFTER DELETE ON interactions
+        WHEN OLD.is_like = 1
+        BEGIN
+            UPDATE bot_stats SET value = value - 1 WHERE name = 'total_likes';
+        END''',
+    ]),
+    # Фильтры постраничного /users идут по индексу в порядке user_id
+    (6, [
+        'CREATE INDEX IF NOT EXISTS idx_users_banned_id ON users (is_banned, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_verified_id ON users (profile_verified, user_id)',
+    ]),
+    # Очередь проверки анкет с арендой: каждый верификатор забирает свою пачку
+    (7, [
+        '''CREATE TABLE IF NOT EXISTS verification_queue (
+            user_id INTEGER PRIMARY KEY,
+            submitted_at REAL NOT NULL,
+            claimed_by INTEGER,
+            lease_expires_at REAL NOT NULL DEFAULT 0
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_verification_queue_lease ON verification_queue (lease_expires_at, submitted_at)',
+        '''INSERT OR IGNORE INTO verification_queue (user_id, submitted_at)
+        SELECT user_id, CAST(strftime('%s', 'now') AS REAL) FROM users
+        WHERE profile_verified = 0 AND roblox_nickname IS NOT NULL''',
+    ]),
+    # Теги режимов из текста анкеты: по первичному ключу (mode, user_id)
+    # находятся анкеты режима, по индексу user_id - режимы анкеты
+    (8, [
+        '''CREATE TABLE IF NOT EXISTS user_modes (
+            mode TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (mode, user_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_user_modes_user ON user_modes (user_id)',
+        fill_user_modes,
+    ]),
+    # Флаг "пришел по ссылке, награда еще не выдана": реферал проверяется
+    # только для таких пользователей, а не на каждом лайке
+    (9, [
+        'ALTER TABLE users ADD COLUMN referral_pending INTEGER NOT NULL DEFAULT 0',
+        REFERRAL_PENDING_REPAIR_SQL,
+        'CREATE INDEX IF NOT EXISTS idx_users_referral_pending ON users (user_id) WHERE referral_pending = 1',
+    ]),
+    # Время хранится целыми секундами Unix вместо ISO-строк: строки короче,
+    # сравнение и сортировка - по числам
+    (10, [
+        convert_timestamps_to_epoch,
+    ]),
+    # Пул анкет для поиска с плотной нумерацией slot = 1..N: случайное окно
+    # выбирается по номеру, а не по значению user_id, в котором есть большие
+    # промежутки. При удалении на место освободившегося номера переезжает
+    # последний, так что номера остаются без дыр.
+    (11, [
+        '''CREATE TABLE IF NOT EXISTS sample_pool (
+            slot INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL UNIQUE
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_sample_pool_compact AFTER DELETE ON sample_pool
+        BEGIN
+            UPDATE sample_pool SET slot = OLD.slot
+            WHERE slot = (SELECT MAX(slot) FROM sample_pool) AND slot > OLD.slot;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_sample_pool_users_insert AFTER INSERT ON users
+        WHEN NEW.profile_verified IS 1 AND NEW.is_banned IS 0
+        BEGIN
+            INSERT OR IGNORE INTO sample_pool (user_id) VALUES (NEW.user_id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_sample_pool_users_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM sample_pool WHERE user_id = OLD.user_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_sample_pool_users_status AFTER UPDATE OF profile_verified, is_banned ON users
+        WHEN (NEW.profile_verified IS 1 AND NEW.is_banned IS 0) != (OLD.profile_verified IS 1 AND OLD.is_banned IS 0)
+        BEGIN
+            DELETE FROM sample_pool WHERE user_id = NEW.user_id
+                AND NOT (NEW.profile_verified IS 1 AND NEW.is_banned IS 0);
+            INSERT OR IGNORE INTO sample_pool (user_id)
+                SELECT NEW.user_id WHERE NEW.profile_verified IS 1 AND NEW.is_banned IS 0;
+        END''',
+        '''INSERT OR IGNORE INTO sample_pool (user_id)
+        SELECT user_id FROM users WHERE profile_verified = 1 AND is_banned = 0 ORDER BY user_id''',
+    ]),
+    # Плотные номера анкет внутри каждого режима для выборки с общим режимом,
+    # поддерживаются так же, как номера в sample_pool
+    (12, [
+        'ALTER TABLE user_modes ADD COLUMN slot INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_user_modes_slot ON user_modes (mode, slot)',
+        '''CREATE TRIGGER IF NOT EXISTS trg_user_modes_slot_insert AFTER INSERT ON user_modes
+        BEGIN
+            UPDATE user_modes SET slot = (SELECT IFNULL(MAX(slot), 0) + 1 FROM user_modes WHERE mode = NEW.mode)
+            WHERE mode = NEW.mode AND user_id = NEW.user_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_user_modes_slot_delete AFTER DELETE ON user_modes
+        WHEN OLD.slot IS NOT NULL
+        BEGIN
+            UPDATE user_modes SET slot = OLD.slot
+            WHERE mode = OLD.mode AND slot = (SELECT MAX(slot) FROM user_modes WHERE mode = OLD.mode)
+            AND slot > OLD.slot;
+        END''',
+        fill_user_modes,
+    ]),
+    # Очередь проверки и состояния диалогов тоже хранят целые секунды Unix
+    (13, [
+        functools.partial(convert_timestamps_to_epoch, columns=FLOAT_TIMESTAMP_COLUMNS),
+    ]),
+]
+
+
+class Database:
+    def __init__(self, path: str = DB_PATH, create: bool = True, readonly: bool = False,
+                 profile: str = DB_PROFILE):
+        self.path = path
+        if readonly:
+            uri = f"{Path(path).absolute().as_uri()}?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.apply_profile(profile, readonly)
+
+        # Пользователи с referral_pending = 1 и сроки кулдаунов матчей,
+        # загружаются при первом лайке
+        self._referral_pending: Optional[set] = None
+        self._cooldowns: Optional[Dict[int, int]] = None
+
+        if create:
+            self.create_tables()
+            self.migrate()
+
+    def apply_profile(self, profile: str, readonly: bool = False):
+        """Применяет PRAGMA из профиля STORAGE_PROFILES"""
+        settings = STORAGE_PROFILES[profile]
+        cursor = self.conn.cursor()
+
+        if readonly:
+            cursor.execute('PRAGMA query_only = 1')
+        else:
+            # Режим журнала хранится в файле базы, его меняет только писатель
+            cursor.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+            cursor.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+
+        cursor.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+        cursor.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+        cursor.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
 
     def create_tables(self):
+        # Начальная схема, дальше ее меняют MIGRATIONS. Столбцы времени
+        # с миграции 10 хранят INTEGER - секунды Unix
         cursor = self.conn.cursor()
 
         # Пользователи
@@ -132,6 +793,39 @@ class Database:
 
         self.conn.commit()
 
+    def migrate(self):
+        """Применяет недостающие миграции схемы"""
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        applied = False
+
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+
+            try:
+                cursor.execute('BEGIN')
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+                cursor.execute(f'PRAGMA user_version = {target}')
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                logger.exception("Ошибка миграции схемы до версии %s", target)
+                raise
+
+            applied = True
+            logger.info("Схема БД обновлена до версии %s", target)
+
+        if applied:
+            # Обновляем статистику для планировщика запросов
+            cursor.execute('ANALYZE')
+            self.conn.commit()
+
     def add_user(self, user_id: int, username: str):
         """Добавляет нового пользователя"""
         cursor = self.conn.cursor()
@@ -141,7 +835,7 @@ class Database:
             INSERT OR IGNORE INTO users 
             (user_id, username, referral_code, created_at)
             VALUES (?, ?, ?, ?)
-        ''', (user_id, username, referral_code, datetime.now().isoformat()))
+        ''', (user_id, username, referral_code, int(time.time())))
 
         self.conn.commit()
 
@@ -154,6 +848,8 @@ class Database:
             SET roblox_nickname = ?, photo_id = ?, game_modes = ?, profile_verified = 0
             WHERE user_id = ?
         ''', (roblox_nickname, photo_id, game_modes, user_id))
+        self._set_modes(cursor, user_id, game_modes)
+        self._enqueue_verification(cursor, user_id)
 
         self.conn.commit()
 
@@ -183,8 +879,18 @@ class Database:
             query = f"UPDATE users SET {', '.join(update_fields)} WHERE user_id = ?"
             params.append(user_id)
             cursor.execute(query, params)
+            if game_modes is not None:
+                self._set_modes(cursor, user_id, game_modes)
+            self._enqueue_verification(cursor, user_id)
             self.conn.commit()
 
+    @staticmethod
+    def _set_modes(cursor, user_id: int, game_modes: Optional[str]):
+        """Заменяет теги режимов анкеты внутри текущей транзакции"""
+        cursor.execute('DELETE FROM user_modes WHERE user_id = ?', (user_id,))
+        cursor.executemany('INSERT OR IGNORE INTO user_modes (mode, user_id) VALUES (?, ?)',
+                           ((mode, user_id) for mode in parse_game_modes(game_modes)))
+
     def get_user_profile(self, user_id: int):
         """Получает профиль пользователя"""
         cursor = self.conn.cursor()
@@ -195,30 +901,82 @@ class Database:
         """Одобряет анкету пользователя"""
         cursor = self.conn.cursor()
         cursor.execute('UPDATE users SET profile_verified = 1 WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM verification_queue WHERE user_id = ?', (user_id,))
         self.conn.commit()
 
     def reject_profile(self, user_id: int):
         """Отклоняет анкету пользователя"""
-        cursor = db.conn.cursor()
+        cursor = self.conn.cursor()
         cursor.execute('UPDATE users SET profile_verified = 2 WHERE user_id = ?', (user_id,))
-        db.conn.commit()
+        cursor.execute('DELETE FROM verification_queue WHERE user_id = ?', (user_id,))
+        self.conn.commit()
 
-    def get_pending_verifications(self):
-        """Получает анкеты на проверке"""
-        cursor = self.conn.cursor()
+    def _enqueue_verification(self, cursor, user_id: int):
+        """Ставит анкету в конец очереди проверки, снимая прежний захват"""
         cursor.execute('''
-            SELECT user_id, username, roblox_nickname, photo_id, game_modes 
-            FROM users 
-            WHERE profile_verified = 0 AND roblox_nickname IS NOT NULL
-        ''')
-        return cursor.fetchall()
+            INSERT INTO verification_queue (user_id, submitted_at, claimed_by, lease_expires_at)
+            VALUES (?, ?, NULL, 0)
+            ON CONFLICT (user_id) DO UPDATE SET
+                submitted_at = excluded.submitted_at, claimed_by = NULL, lease_expires_at = 0
+        ''', (user_id, int(time.time())))
+
+    def claim_verifications(self, verifier_id: int, limit: int, lease_seconds: int):
+        """Захватывает для верификатора следующую пачку анкет
+
+        Берутся свободные анкеты, анкеты с истекшей арендой и уже взятые этим
+        верификатором (их аренда продлевается), в порядке подачи. Пачка
+        захватывается одним UPDATE, поэтому два верификатора не получат одну
+        анкету. Возвращает (анкеты, сколько еще свободно в очереди).
+        """
+        now = int(time.time())
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE verification_queue SET claimed_by = ?, lease_expires_at = ?
+                WHERE user_id IN (
+                    SELECT q.user_id FROM verification_queue q
+                    JOIN users u ON u.user_id = q.user_id
+                    WHERE (q.lease_expires_at <= ? OR q.claimed_by = ?)
+                        AND u.profile_verified = 0 AND u.roblox_nickname IS NOT NULL
+                    ORDER BY q.claimed_by IS NOT ?, q.submitted_at
+                    LIMIT ?
+                )
+            ''', (verifier_id, now + lease_seconds, now, verifier_id, verifier_id, limit))
+
+            cursor.execute('''
+                SELECT u.user_id, u.username, u.roblox_nickname, u.photo_id, u.game_modes
+                FROM verification_queue q
+                JOIN users u ON u.user_id = q.user_id
+                WHERE q.claimed_by = ? AND q.lease_expires_at > ?
+                ORDER BY q.submitted_at
+            ''', (verifier_id, now))
+            claimed = cursor.fetchall()
 
-    def find_likes_for_user(self, user_id: int) -> List:
+            cursor.execute('SELECT COUNT(*) FROM verification_queue WHERE lease_expires_at <= ?', (now,))
+            available = cursor.fetchone()[0]
+
+        return claimed, available
+
+    # Поля анкеты, которые нужны для карточки в поиске
+    CANDIDATE_COLUMNS = 'u.user_id, u.roblox_nickname, u.game_modes, u.photo_id, u.matches_found'
+
+    def get_candidate(self, user_id: int) -> Optional[Candidate]:
+        """Получает карточку анкеты, если она одобрена и не забанена"""
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT {self.CANDIDATE_COLUMNS}
+            FROM users u
+            WHERE u.user_id = ? AND u.profile_verified = 1 AND u.is_banned = 0
+        ''', (user_id,))
+        row = cursor.fetchone()
+        return Candidate(*row) if row else None
+
+    def find_likes_for_user(self, user_id: int) -> List[Candidate]:
         """Находит пользователей, которые лайкнули текущего пользователя"""
         cursor = self.conn.cursor()
 
-        cursor.execute('''
-            SELECT u.* 
+        cursor.execute(f'''
+            SELECT {self.CANDIDATE_COLUMNS}
             FROM interactions i
             JOIN users u ON i.from_user_id = u.user_id
             WHERE i.to_user_id = ? 
@@ -228,129 +986,331 @@ class Database:
                 WHERE i2.from_user_id = ? 
                 AND i2.to_user_id = i.from_user_id
             )
-            ORDER BY i.sent_at DESC
+            ORDER BY i.sent_at DESC, i.interaction_id DESC
             LIMIT 10
         ''', (user_id, user_id))
 
-        return cursor.fetchall()
-
-    def find_random_teammates(self, user_id: int) -> List:
-        """Находит случайных тиммейтов (кроме тех, с кем уже было взаимодействие)"""
-        cursor = self.conn.cursor()
+        return [Candidate(*row) for row in cursor.fetchall()]
 
-        cursor.execute('''
-            SELECT u.* 
-            FROM users u
-            WHERE u.user_id != ? 
-            AND u.profile_verified = 1
-            AND u.is_banned = 0
+    # Кандидат еще не просмотрен: я его не оценивал и он меня не лайкал
+    UNSEEN_FILTER = '''
+            AND u.user_id != ?
             AND NOT EXISTS (
                 SELECT 1 FROM interactions i 
-                WHERE (i.from_user_id = ? AND i.to_user_id = u.user_id)
-                OR (i.from_user_id = u.user_id AND i.to_user_id = ? AND i.is_like = 1)
+                WHERE i.from_user_id = ? AND i.to_user_id = u.user_id
             )
-            ORDER BY RANDOM()
-            LIMIT 10
-        ''', (user_id, user_id, user_id))
-
-        return cursor.fetchall()
-
-    def add_interaction(self, from_user_id: int, to_user_id: int, is_like: bool, message: str = ''):
-        """Добавляет взаимодействие между пользователями"""
+            AND NOT EXISTS (
+                SELECT 1 FROM interactions i 
+                WHERE i.from_user_id = u.user_id AND i.to_user_id = ? AND i.is_like = 1
+            )
+    '''
+
+    def _sample_shared_modes(self, cursor, user_id: int, limit: int) -> Dict[int, Candidate]:
+        """Непросмотренные анкеты, у которых есть общий режим с анкетой user_id
+
+        У анкет каждого режима в user_modes плотные номера slot = 1..N, окна
+        берутся от случайного номера, как в основной выборке по sample_pool.
+        Число чтений индекса не зависит от размера таблицы.
+        """
+        cursor.execute('SELECT mode FROM user_modes WHERE user_id = ?', (user_id,))
+        modes = [row[0] for row in cursor.fetchall()]
+        # Индекс отдает режимы по алфавиту, без перемешивания первый режим
+        # заполнял бы всю колоду
+        random.shuffle(modes)
+
+        sizes = {}
+        for mode in modes[:SAMPLER_MAX_MODES]:
+            cursor.execute('SELECT MAX(slot) FROM user_modes WHERE mode = ?', (mode,))
+            size = cursor.fetchone()[0]
+            if size is not None and size >= 2:  # Иначе режим есть только у самого пользователя
+                sizes[mode] = size
+
+        found = {}
+        # Окна берутся по кругу, по одному на каждый режим, чтобы в колоду
+        # попадали игроки всех общих режимов
+        for _ in range(SAMPLER_MODE_WINDOWS):
+            for mode, size in list(sizes.items()):
+                for low, high in self._slot_ranges(random.randint(1, size), SAMPLER_WINDOW_SIZE, size):
+                    cursor.execute(f'''
+                        SELECT {self.CANDIDATE_COLUMNS}
+                        FROM user_modes m
+                        JOIN users u ON u.user_id = m.user_id
+                        WHERE m.mode = ? AND m.slot BETWEEN ? AND ?
+                        AND u.profile_verified = 1 AND u.is_banned = 0
+                        {self.UNSEEN_FILTER}
+                    ''', (mode, low, high, user_id, user_id, user_id))
+                    for row in cursor.fetchall():
+                        found[row[0]] = Candidate(*row)
+
+                if size <= SAMPLER_WINDOW_SIZE:
+                    del sizes[mode]  # Маленький режим целиком помещается в одно окно
+
+            if len(found) >= limit or not sizes:
+                break
+        return found
+
+    @staticmethod
+    def _slot_ranges(start: int, count: int, size: int) -> List[tuple]:
+        """Отрезки номеров [start, start + count) на круге 1..size"""
+        end = start + min(count, size) - 1
+        if end <= size:
+            return [(start, end)]
+        return [(start, size), (1, end - size)]
+
+    @staticmethod
+    def _deal(shared: Dict[int, Candidate], found: Dict[int, Candidate], limit: int) -> List[Candidate]:
+        """Колода: сначала анкеты с общими режимами, потом остальные, каждая часть перемешана"""
+        first = list(shared.values())
+        rest = [candidate for candidate_id, candidate in found.items() if candidate_id not in shared]
+        random.shuffle(first)
+        random.shuffle(rest)
+        return (first + rest)[:limit]
+
+    def find_random_teammates(self, user_id: int, limit: int = 10) -> List[Candidate]:
+        """Находит случайных тиммейтов (кроме тех, с кем уже было взаимодействие)
+
+        Сначала берутся анкеты с общим режимом игры (_sample_shared_modes),
+        недостающие добираются из всех анкет. Вместо ORDER BY RANDOM() по всем
+        анкетам читает несколько окон пула sample_pool, начиная со случайного
+        номера slot, и отбрасывает уже просмотренных. Номера плотные, поэтому
+        каждая анкета попадает в окно с одинаковой вероятностью, как бы ни
+        были разбросаны user_id. Каждое окно стоит фиксированное число чтений
+        индекса, поэтому время не растет вместе с таблицей.
+        """
         cursor = self.conn.cursor()
-
-        # Проверяем существование записи
-        cursor.execute('''
-            SELECT 1 FROM interactions 
-            WHERE from_user_id = ? AND to_user_id = ? AND is_like = ?
-        ''', (from_user_id, to_user_id, 1 if is_like else 0))
-
-        if cursor.fetchone():
-            return  # Взаимодействие уже существует
-
+        shared = self._sample_shared_modes(cursor, user_id, limit)
+        if len(shared) >= limit:
+            return self._deal(shared, {}, limit)
+
+        cursor.execute('SELECT MAX(slot) FROM sample_pool')
+        size = cursor.fetchone()[0]
+        if not size:
+            return self._deal(shared, {}, limit)
+
+        found = dict(shared)
+        for _ in range(SAMPLER_MAX_WINDOWS):
+            for low, high in self._slot_ranges(random.randint(1, size), SAMPLER_WINDOW_SIZE, size):
+                cursor.execute(f'''
+                    SELECT {self.CANDIDATE_COLUMNS}
+                    FROM sample_pool s
+                    JOIN users u ON u.user_id = s.user_id
+                    WHERE s.slot BETWEEN ? AND ?
+                    {self.UNSEEN_FILTER}
+                ''', (low, high, user_id, user_id, user_id))
+
+                for row in cursor.fetchall():
+                    found[row[0]] = Candidate(*row)
+            if len(found) >= limit:
+                return self._deal(shared, found, limit)
+
+        # Окна почти пустые - пользователь просмотрел большинство анкет.
+        # Досматриваем пул по кругу от случайного номера.
+        pivot = random.randint(1, size)
+        for condition in ('s.slot >= ?', 's.slot < ?'):
+            cursor.execute(f'''
+                SELECT {self.CANDIDATE_COLUMNS}
+                FROM sample_pool s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE {condition}
+                {self.UNSEEN_FILTER}
+                LIMIT ?
+            ''', (pivot, user_id, user_id, user_id, limit))
+
+            for row in cursor.fetchall():
+                found[row[0]] = Candidate(*row)
+            if len(found) >= limit:
+                break
+
+        return self._deal(shared, found, limit)
+
+    def add_interaction(self, from_user_id: int, to_user_id: int, is_like: bool, message: str = '') -> bool:
+        """Добавляет взаимодействие между пользователями
+
+        Все изменения (лайк, тимбалы, матч, реферальная награда) выполняются
+        одной транзакцией с одним коммитом. Возвращает False, если оценка
+        этой анкеты уже была.
+        """
+        try:
+            with self.conn:
+                return self._insert_interaction(
+                    self.conn.cursor(), from_user_id, to_user_id, is_like, message, int(time.time()))
+        except Exception:
+            self._reset_like_caches()
+            raise
+
+    def add_interactions(self, interactions: List[tuple]) -> int:
+        """Добавляет пачку взаимодействий одной транзакцией
+
+        Элементы: (from_user_id, to_user_id, is_like, message, sent_at).
+        Если пачка не записалась целиком, записывает элементы по одному,
+        чтобы одна ошибка не потеряла остальные. Возвращает число добавленных.
+        """
+        try:
+            with self.conn:
+                cursor = self.conn.cursor()
+                return sum(self._insert_interaction(cursor, *item) for item in interactions)
+        except sqlite3.Error as e:
+            self._reset_like_caches()
+            logger.error("Ошибка записи пачки взаимодействий, пишем по одному: %s", e)
+
+        added = 0
+        for item in interactions:
+            try:
+                with self.conn:
+                    added += self._insert_interaction(self.conn.cursor(), *item)
+            except sqlite3.Error as e:
+                self._reset_like_caches()
+                logger.error("Не удалось записать взаимодействие %s: %s", item[:3], e)
+        return added
+
+    def _insert_interaction(self, cursor, from_user_id: int, to_user_id: int, is_like: bool,
+                            message: str, now: int) -> bool:
+        """Записывает взаимодействие внутри текущей транзакции"""
         cursor.execute('''
             INSERT INTO interactions 
             (from_user_id, to_user_id, is_like, message, sent_at)
             VALUES (?, ?, ?, ?, ?)
-        ''', (from_user_id, to_user_id, 1 if is_like else 0, message, datetime.now().isoformat()))
+            ON CONFLICT (from_user_id, to_user_id) DO NOTHING
+        ''', (from_user_id, to_user_id, 1 if is_like else 0, message, now))
+
+        if cursor.rowcount == 0:
+            return False  # Взаимодействие уже существует
 
         if is_like:
-            # Добавляем тимбалы
-            self.add_team_balls(from_user_id, TEAMBALLS_PER_MATCH)
-
-            # Проверяем кулдаун
-            cursor.execute('SELECT last_match_time FROM users WHERE user_id = ?', (from_user_id,))
-            last_time_result = cursor.fetchone()
-
-            can_add_match = True
-            if last_time_result and last_time_result[0]:
-                last_time = datetime.fromisoformat(last_time_result[0])
-                time_diff = datetime.now() - last_time
-                if time_diff < timedelta(hours=MATCH_COOLDOWN_HOURS):
-                    can_add_match = False
-                    logger.info(f"Кулдаун для пользователя {from_user_id}: прошло {time_diff}")
-
-            if can_add_match:
-                cursor.execute('''
-                    UPDATE users 
-                    SET matches_found = matches_found + 1, last_match_time = ?
-                    WHERE user_id = ?
-                ''', (datetime.now().isoformat(), from_user_id))
-                logger.info(f"Добавлен матч для пользователя {from_user_id}")
-
-            # Проверяем реферальную программу
-            self.check_referral_completion(from_user_id)
+            cursor.execute('UPDATE users SET likes_received = likes_received + 1 WHERE user_id = ?',
+                           (to_user_id,))
+            self._apply_like(cursor, from_user_id, now)
 
-        self.conn.commit()
+        return True
+
+    def _apply_like(self, cursor, user_id: int, now: int):
+        """Начисляет награды за лайк внутри текущей транзакции"""
+        cooldowns = self._match_cooldowns(cursor, now)
+
+        if cooldowns.get(user_id, 0) > now:
+            # Кулдаун еще идет: только тимбалы, матч не засчитывается
+            cursor.execute('UPDATE users SET team_balls = team_balls + ? WHERE user_id = ?',
+                           (TEAMBALLS_PER_MATCH, user_id))
+            log_event("swipe", "Кулдаун", user_id=user_id)
+            return
+
+        cursor.execute('''
+            UPDATE users
+            SET team_balls = team_balls + ?, matches_found = matches_found + 1, last_match_time = ?
+            WHERE user_id = ?
+        ''', (TEAMBALLS_PER_MATCH, now, user_id))
+        if not cursor.rowcount:
+            return
+
+        # Переставляем в конец, чтобы словарь оставался упорядочен по сроку
+        cooldowns.pop(user_id, None)
+        cooldowns[user_id] = now + int(MATCH_COOLDOWN_HOURS * 3600)
+        log_event("swipe", "Добавлен матч", user_id=user_id)
+
+        # Реферал проверяем, только если матч засчитан и награда еще не выдана
+        if user_id in self._pending_referrals(cursor):
+            self._complete_referral(cursor, user_id)
+
+    def _match_cooldowns(self, cursor, now: int) -> Dict[int, int]:
+        """Конец кулдауна матчей по user_id, по возрастанию срока
+
+        Загружается из last_match_time при первом лайке, дальше ведется в
+        памяти вместе с записью в базу. Истекшие записи удаляются с начала.
+        """
+        if self._cooldowns is None:
+            cursor.execute('SELECT user_id, last_match_time FROM users WHERE last_match_time > ? '
+                           'ORDER BY last_match_time', (now - int(MATCH_COOLDOWN_HOURS * 3600),))
+            self._cooldowns = {user_id: last_match + int(MATCH_COOLDOWN_HOURS * 3600)
+                               for user_id, last_match in cursor.fetchall()}
+
+        cooldowns = self._cooldowns
+        while cooldowns:
+            user_id, expires_at = next(iter(cooldowns.items()))
+            if expires_at > now:
+                break
+            del cooldowns[user_id]
+        return cooldowns
+
+    def _reset_like_caches(self):
+        """Транзакция лайков откатилась: флаги рефералов и кулдауны перечитаются из базы"""
+        self._referral_pending = None
+        self._cooldowns = None
+
+    def _pending_referrals(self, cursor) -> set:
+        """Пользователи с незавершенным рефералом (по частичному индексу на referral_pending)"""
+        if self._referral_pending is None:
+            cursor.execute('SELECT user_id FROM users WHERE referral_pending = 1')
+            self._referral_pending = {row[0] for row in cursor.fetchall()}
+        return self._referral_pending
 
     def get_user_interactions(self, user_id: int):
         """Получает взаимодействия пользователя"""
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT u.*, i.message, i.sent_at
+            SELECT u.user_id, u.username, u.roblox_nickname, u.photo_id, u.game_modes, i.message, i.sent_at
             FROM interactions i
             JOIN users u ON i.from_user_id = u.user_id
             WHERE i.to_user_id = ? AND i.is_like = 1
-            ORDER BY i.sent_at DESC
+            ORDER BY i.sent_at DESC, i.interaction_id DESC
         ''', (user_id,))
         return cursor.fetchall()
 
     def add_team_balls(self, user_id: int, amount: int):
         """Добавляет тимбалы пользователю"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT team_balls FROM users WHERE user_id = ?', (user_id,))
-        current = cursor.fetchone()
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('UPDATE users SET team_balls = team_balls + ? WHERE user_id = ?', (amount, user_id))
 
-        if current:
-            new_amount = current[0] + amount
-            cursor.execute('UPDATE users SET team_balls = ? WHERE user_id = ?', (new_amount, user_id))
-            logger.info(f"Тимбалы пользователя {user_id}: {current[0]} + {amount} = {new_amount}")
-            self.conn.commit()
+        if cursor.rowcount:
+            log_event("balance", "Тимбалы изменены", user_id=user_id, amount=amount)
             return True
         return False
 
-    def check_referral_completion(self, referred_id: int):
-        """Проверяет выполнение условий реферальной программы"""
-        cursor = self.conn.cursor()
+    def purchase_promo(self, user_id: int, promo_type: str, price: int) -> bool:
+        """Списывает тимбалы и записывает покупку, если баланса хватает"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE users SET team_balls = team_balls - ?
+                WHERE user_id = ? AND team_balls >= ?
+            ''', (price, user_id, price))
 
-        cursor.execute('SELECT matches_found FROM users WHERE user_id = ?', (referred_id,))
-        result = cursor.fetchone()
+            if cursor.rowcount == 0:
+                return False
 
-        if result and result[0] >= REFERRAL_MATCHES_REQUIRED:
-            cursor.execute('SELECT referrer_id FROM referrals WHERE referred_id = ? AND completed = 0', (referred_id,))
-            referral = cursor.fetchone()
+            cursor.execute('''
+                INSERT INTO purchases (user_id, promo_type, team_balls_spent, purchased_at)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, promo_type, price, int(time.time())))
 
-            if referral:
-                referrer_id = referral[0]
-                # Даем награду рефереру
-                self.add_team_balls(referrer_id, TEAMBALLS_PER_REFERRAL)
-                cursor.execute('UPDATE referrals SET completed = 1 WHERE referred_id = ?', (referred_id,))
-                self.conn.commit()
+        return True
 
-                logger.info(f"Реферальная программа выполнена: {referrer_id} получил награду за {referred_id}")
-                return referrer_id
+    def _complete_referral(self, cursor, referred_id: int):
+        """Засчитывает реферала внутри текущей транзакции"""
+        cursor.execute('''
+            SELECT r.referrer_id
+            FROM referrals r
+            JOIN users u ON u.user_id = r.referred_id
+            WHERE r.referred_id = ? AND r.completed = 0 AND u.matches_found >= ?
+        ''', (referred_id, REFERRAL_MATCHES_REQUIRED))
+        referral = cursor.fetchone()
+
+        if not referral:
+            return None
+
+        referrer_id = referral[0]
+        cursor.execute('UPDATE referrals SET completed = 1 WHERE referred_id = ?', (referred_id,))
+        cursor.execute('UPDATE users SET referral_pending = 0 WHERE user_id = ?', (referred_id,))
+        if self._referral_pending is not None:
+            self._referral_pending.discard(referred_id)
+        # Даем награду рефереру
+        cursor.execute('''
+            UPDATE users SET team_balls = team_balls + ?, referrals_completed = referrals_completed + 1
+            WHERE user_id = ?
+        ''', (TEAMBALLS_PER_REFERRAL, referrer_id))
 
-        return None
+        logger.info("Реферальная программа выполнена: %s получил награду за %s", referrer_id, referred_id)
+        return referrer_id
 
     def add_referral(self, referrer_id: int, referred_id: int):
         """Добавляет реферала"""
@@ -363,18 +1323,12 @@ class Database:
             cursor.execute('''
                 INSERT INTO referrals (referrer_id, referred_id, created_at)
                 VALUES (?, ?, ?)
-            ''', (referrer_id, referred_id, datetime.now().isoformat()))
+            ''', (referrer_id, referred_id, int(time.time())))
+            cursor.execute('UPDATE users SET referral_pending = 1 WHERE user_id = ?', (referred_id,))
             self.conn.commit()
-            logger.info(f"Добавлен реферал: {referrer_id} -> {referred_id}")
-
-    def add_purchase(self, user_id: int, promo_type: str, team_balls_spent: int):
-        """Добавляет запись о покупке"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO purchases (user_id, promo_type, team_balls_spent, purchased_at)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, promo_type, team_balls_spent, datetime.now().isoformat()))
-        self.conn.commit()
+            if self._referral_pending is not None:
+                self._referral_pending.add(referred_id)
+            logger.info("Добавлен реферал: %s -> %s", referrer_id, referred_id)
 
     def add_support_message(self, user_id: int, message: str):
         """Добавляет сообщение в поддержку"""
@@ -382,7 +1336,7 @@ class Database:
         cursor.execute('''
             INSERT INTO support_messages (user_id, message, created_at)
             VALUES (?, ?, ?)
-        ''', (user_id, message, datetime.now().isoformat()))
+        ''', (user_id, message, int(time.time())))
         self.conn.commit()
 
     def get_user_by_username(self, username: str):
@@ -392,12 +1346,80 @@ class Database:
         result = cursor.fetchone()
         return result[0] if result else None
 
-    def get_all_users(self):
-        """Получает всех пользователей"""
+    # Фильтры постраничного списка /users: условие WHERE и имя итога в bot_stats
+    USER_FILTERS = {
+        "all": ("1", "total_users"),
+        "banned": ("is_banned = 1", "banned_users"),
+        "pending": ("profile_verified = 0 AND roblox_nickname IS NOT NULL", "pending_users"),
+        "verified": ("profile_verified = 1", "verified_users"),
+    }
+
+    def get_users_page(self, status: str = "all", after_id: Optional[int] = None,
+                       before_id: Optional[int] = None, limit: int = 30):
+        """Страница пользователей по возрастанию user_id (keyset-пагинация)
+
+        Следующая страница начинается после after_id, предыдущая заканчивается
+        перед before_id. Читается limit + 1 строка: лишняя означает, что в
+        этом направлении есть еще страница. Возвращает (строки, есть_еще).
+        """
+        condition = self.USER_FILTERS[status][0]
+        columns = 'user_id, username, roblox_nickname, team_balls, is_banned, profile_verified'
+        cursor = self.conn.cursor()
+
+        if before_id is not None:
+            cursor.execute(f'''
+                SELECT {columns} FROM users
+                WHERE {condition} AND user_id < ?
+                ORDER BY user_id DESC LIMIT ?
+            ''', (before_id, limit + 1))
+            rows = cursor.fetchall()
+            return rows[:limit][::-1], len(rows) > limit
+
+        cursor.execute(f'''
+            SELECT {columns} FROM users
+            WHERE {condition} AND user_id > ?
+            ORDER BY user_id LIMIT ?
+        ''', (after_id if after_id is not None else -1, limit + 1))
+        rows = cursor.fetchall()
+        return rows[:limit], len(rows) > limit
+
+    def get_leaderboard_rows(self):
+        """Балансы всех участников рейтинга (одобрены и не забанены)"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT user_id, username, roblox_nickname, team_balls, is_banned, profile_verified FROM users')
+        cursor.execute('SELECT user_id, team_balls FROM users WHERE profile_verified = 1 AND is_banned = 0')
         return cursor.fetchall()
 
+    def get_users_brief(self, user_ids: List[int]) -> Dict[int, tuple]:
+        """Username и ник в Roblox для списка пользователей: {user_id: (username, roblox_nickname)}"""
+        if not user_ids:
+            return {}
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT user_id, username, roblox_nickname FROM users
+            WHERE user_id IN ({', '.join('?' * len(user_ids))})
+        ''', list(user_ids))
+        return {user_id: (username, nickname) for user_id, username, nickname in cursor.fetchall()}
+
+    def watch_balances(self, callback):
+        """Вызывает callback(user_id, team_balls, ranked) при каждом изменении баланса или статуса
+
+        Временный триггер живет только в этом соединении, поэтому другие
+        программы, работающие с файлом базы, функцию регистрировать не должны.
+        Триггер срабатывает на любом пути записи: лайки, рефералы, покупки,
+        начисления и обнуления админом, одобрение, бан. callback вызывается
+        внутри транзакции, до коммита, и о последующем откате не узнает.
+        """
+        self.conn.create_function("balance_changed", 3, callback)
+        self.conn.execute('''
+            CREATE TEMP TRIGGER IF NOT EXISTS trg_watch_balances
+            AFTER UPDATE OF team_balls, profile_verified, is_banned ON main.users
+            WHEN NEW.team_balls IS NOT OLD.team_balls OR NEW.profile_verified IS NOT OLD.profile_verified
+                OR NEW.is_banned IS NOT OLD.is_banned
+            BEGIN
+                SELECT balance_changed(NEW.user_id, NEW.team_balls, NEW.profile_verified = 1 AND NEW.is_banned = 0);
+            END
+        ''')
+
     def get_top_users_by_teamballs(self, limit: int = 20):
         """Получает топ пользователей по тимбалам"""
         cursor = self.conn.cursor()
@@ -410,11 +1432,524 @@ class Database:
         ''', (limit,))
         return cursor.fetchall()
 
+    def get_user_id_by_referral_code(self, referral_code: str):
+        """Находит пользователя по реферальному коду"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def get_recent_like_messages(self, user_id: int, limit: int = 10):
+        """Получает последние сообщения к лайкам"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT u.username, u.team_balls, i.message, i.sent_at
+            FROM interactions i
+            JOIN users u ON i.from_user_id = u.user_id
+            WHERE i.to_user_id = ? AND i.is_like = 1
+            ORDER BY i.sent_at DESC, i.interaction_id DESC LIMIT ?
+        ''', (user_id, limit))
+        return cursor.fetchall()
+
+    def repair_counters(self) -> int:
+        """Пересчитывает likes_received, referrals_completed и referral_pending. Возвращает число исправленных"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute(COUNTERS_REPAIR_SQL)
+            repaired = cursor.rowcount
+            cursor.execute(REFERRAL_PENDING_REPAIR_SQL)
+            repaired += cursor.rowcount
+        self._referral_pending = None
+        return repaired
+
+    def rebuild_user_modes(self):
+        """Перестраивает теги режимов всех анкет"""
+        with self.conn:
+            fill_user_modes(self.conn.cursor())
+
+    def set_banned(self, user_id: int, banned: bool):
+        """Банит или разбанивает пользователя"""
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE users SET is_banned = ? WHERE user_id = ?', (1 if banned else 0, user_id))
+        self.conn.commit()
+
+    def add_warning(self, user_id: int) -> Optional[int]:
+        """Выдает предупреждение, на третьем банит. Возвращает число предупреждений"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT warnings FROM users WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+
+        if not result:
+            return None
+
+        warnings = result[0] + 1
+        cursor.execute('UPDATE users SET warnings = ? WHERE user_id = ?', (warnings, user_id))
+        if warnings >= 3:
+            cursor.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,))
+        self.conn.commit()
+        return warnings
+
+    def clear_profile(self, user_id: int):
+        """Очищает анкету пользователя"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'UPDATE users SET roblox_nickname = NULL, photo_id = NULL, game_modes = NULL, profile_verified = 0 WHERE user_id = ?',
+            (user_id,))
+        cursor.execute('DELETE FROM verification_queue WHERE user_id = ?', (user_id,))
+        self._set_modes(cursor, user_id, None)
+        self.conn.commit()
+
+    def clear_team_balls(self, user_id: int):
+        """Обнуляет тимбалы пользователя"""
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE users SET team_balls = 0 WHERE user_id = ?', (user_id,))
+        self.conn.commit()
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика бота из таблицы итогов bot_stats"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT name, value FROM bot_stats')
+        return dict(cursor.fetchall())
+
+    def reconcile_stats(self) -> Dict[str, tuple]:
+        """Сверяет bot_stats с исходными таблицами и исправляет расхождения
+
+        Возвращает {name: (было, стало)} для исправленных итогов.
+        """
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT name, value FROM bot_stats')
+            current = dict(cursor.fetchall())
+            cursor.execute(STATS_TOTALS_SQL)
+            actual = dict(cursor.fetchall())
+
+            drift = {name: (current.get(name), value) for name, value in actual.items()
+                     if current.get(name) != value}
+            cursor.executemany('INSERT OR REPLACE INTO bot_stats (name, value) VALUES (?, ?)',
+                               [(name, value) for name, (_, value) in drift.items()])
+        return drift
+
+    def save_user_state(self, user_id: int, state: Optional[str], expires_at: int):
+        """Сохраняет состояние диалога (None - удаляет)"""
+        with self.conn:
+            if state is None:
+                self.conn.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO user_states (user_id, state, expires_at) VALUES (?, ?, ?)',
+                                  (user_id, state, expires_at))
+
+    def load_user_states(self, now: int) -> List[tuple]:
+        """Удаляет просроченные и возвращает остальные состояния диалогов"""
+        with self.conn:
+            self.conn.execute('DELETE FROM user_states WHERE expires_at <= ?', (now,))
+        cursor = self.conn.execute('SELECT user_id, state, expires_at FROM user_states ORDER BY expires_at')
+        return [(user_id, json.loads(state), expires_at) for user_id, state, expires_at in cursor.fetchall()]
+
+    def close(self):
+        """Закрывает соединение"""
+        self.conn.close()
+
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database.
+
+    Методы Database вызываются как awaitable с теми же именами. Записи идут
+    через один поток-писатель, чтения - через небольшой пул потоков, у каждого
+    из которых свое соединение только для чтения, поэтому диск не блокирует
+    event loop, а в режиме WAL читатели и писатель не ждут друг друга.
+
+    В режиме write_behind лайки и дизлайки складываются в очередь и пишутся
+    фоновой задачей пачками (один коммит на пачку). Еще не записанные свайпы
+    сразу исключаются из выдачи поиска для того же пользователя, а тимбалы и
+    счетчики обновляются через несколько миллисекунд, вместе с пачкой.
+    """
+
+    READ_METHODS = frozenset({
+        "get_user_profile", "find_likes_for_user",
+        "find_random_teammates", "get_user_interactions", "get_user_by_username",
+        "get_users_page", "get_top_users_by_teamballs", "get_user_id_by_referral_code",
+        "get_recent_like_messages", "get_leaderboard_rows", "get_users_brief",
+        "get_stats", "get_candidate",
+    })
+
+    # Записи, после которых анкета может пропасть из поиска или измениться
+    PROFILE_WRITE_METHODS = frozenset({
+        "add_to_verification", "update_user_profile", "approve_profile", "reject_profile",
+        "set_banned", "add_warning", "clear_profile",
+    })
+
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READER_THREADS,
+                 write_behind: bool = DB_WRITE_BEHIND):
+        self._writer = Database(path)
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._readers: List[Database] = []
+        self._readers_lock = threading.Lock()
+        self.writes_in_flight = 0
+        # Номер последнего изменения анкеты: общий счетчик и по пользователям
+        self.profile_generation = 0
+        self._profile_versions: Dict[int, int] = {}
+        # Очередь отложенной записи свайпов
+        self.write_behind = write_behind
+        self._pending: List[tuple] = []
+        self._pending_targets: Dict[int, set] = {}
+        self._has_pending: Optional[asyncio.Event] = None
+        self._batch_full: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def profile_version(self, user_id: int) -> int:
+        """Номер последнего изменения анкеты пользователя (0 - не менялась)"""
+        return self._profile_versions.get(user_id, 0)
+
+    def _touch_profile(self, user_id: int):
+        self.profile_generation += 1
+        self._profile_versions[user_id] = self.profile_generation
+
+    def _reader(self) -> Database:
+        """Соединение для чтения текущего потока пула"""
+        reader = getattr(self._local, "db", None)
+        if reader is None:
+            reader = Database(self._writer.path, create=False, readonly=True)
+            self._local.db = reader
+            with self._readers_lock:
+                self._readers.append(reader)
+        return reader
+
+    @staticmethod
+    def _timed(name: str, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe("bot_db_seconds", time.perf_counter() - started, method=name)
+
+    def _call_reader(self, name: str, args, kwargs):
+        return self._timed(name, getattr(self._reader(), name), *args, **kwargs)
+
+    async def run_write(self, func, *args, **kwargs):
+        """Выполняет функцию над соединением писателя в его потоке"""
+        loop = asyncio.get_running_loop()
+        self.writes_in_flight += 1
+        try:
+            return await loop.run_in_executor(
+                self._write_executor,
+                functools.partial(self._timed, func.__name__, func, self._writer, *args, **kwargs))
+        finally:
+            self.writes_in_flight -= 1
+
+    def __getattr__(self, name: str):
+        method = getattr(Database, name, None)
+        if name.startswith("_") or not callable(method) or name == "close":
+            raise AttributeError(name)
+
+        if name in self.READ_METHODS:
+            async def call(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._read_executor, self._call_reader, name, args, kwargs)
+        elif name in self.PROFILE_WRITE_METHODS:
+            async def call(*args, **kwargs):
+                result = await self.run_write(method, *args, **kwargs)
+                self._touch_profile(kwargs["user_id"] if "user_id" in kwargs else args[0])
+                return result
+        else:
+            async def call(*args, **kwargs):
+                return await self.run_write(method, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        setattr(self, name, call)
+        return call
+
+    def submit_write(self, func, *args):
+        """Ставит запись в очередь писателя, не дожидаясь результата"""
+        future = self._write_executor.submit(self._timed, func.__name__, func, self._writer, *args)
+        future.add_done_callback(self._log_write_error)
+        return future
+
+    @staticmethod
+    def _log_write_error(future):
+        if future.exception() is not None:
+            logger.error("Ошибка фоновой записи в БД: %s", future.exception())
+
+    @property
+    def pending_writes(self) -> int:
+        """Сколько свайпов ждут записи"""
+        return len(self._pending)
+
+    async def add_interaction(self, from_user_id: int, to_user_id: int, is_like: bool, message: str = '') -> bool:
+        """Добавляет взаимодействие сразу или через очередь отложенной записи"""
+        if not self.write_behind:
+            return await self.run_write(Database.add_interaction, from_user_id, to_user_id, is_like, message)
+
+        targets = self._pending_targets.setdefault(from_user_id, set())
+        if to_user_id in targets:
+            return False
+        targets.add(to_user_id)
+        self._pending.append((from_user_id, to_user_id, is_like, message, int(time.time())))
+
+        if self._flusher is None:
+            self._has_pending = asyncio.Event()
+            self._batch_full = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+        self._has_pending.set()
+        if len(self._pending) >= WRITE_BEHIND_BATCH_SIZE:
+            self._batch_full.set()
+        return True
+
+    async def _flush_loop(self):
+        """Фоновая запись очереди: по таймеру или по размеру пачки"""
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), WRITE_BEHIND_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка отложенной записи: %s", e)
+
+    async def flush(self):
+        """Записывает накопленные свайпы одной транзакцией"""
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        self._has_pending.clear()
+        self._batch_full.clear()
+        try:
+            await self.run_write(Database.add_interactions, batch)
+        finally:
+            # Теперь свайпы видны в базе, фильтр в памяти больше не нужен
+            for from_user_id, to_user_id, *_ in batch:
+                targets = self._pending_targets.get(from_user_id)
+                if targets is not None:
+                    targets.discard(to_user_id)
+                    if not targets:
+                        del self._pending_targets[from_user_id]
+
+    async def _read_without_pending(self, name: str, user_id: int, *args) -> List[Candidate]:
+        """Выполняет поиск и убирает из выдачи анкеты, свайп которых еще в очереди
+
+        Свайпы, бывшие в очереди на момент запроса, тоже отсеиваются: пачка
+        могла записаться, пока читатель смотрел на более старый снимок базы.
+        """
+        queued = set(self._pending_targets.get(user_id, ()))
+        loop = asyncio.get_running_loop()
+        candidates = await loop.run_in_executor(
+            self._read_executor, self._call_reader, name, (user_id, *args), {})
+
+        targets = queued.union(self._pending_targets.get(user_id, ()))
+        if not targets:
+            return candidates
+        return [c for c in candidates if c.user_id not in targets]
+
+    async def find_likes_for_user(self, user_id: int) -> List[Candidate]:
+        """Находит пользователей, которые лайкнули текущего пользователя"""
+        return await self._read_without_pending("find_likes_for_user", user_id)
+
+    async def find_random_teammates(self, user_id: int, limit: int = 10) -> List[Candidate]:
+        """Находит случайных тиммейтов (кроме тех, с кем уже было взаимодействие)"""
+        return await self._read_without_pending("find_random_teammates", user_id, limit)
+
+    async def aclose(self):
+        """Останавливает фоновую запись, дописывает очередь и закрывает базу"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """Дожидается незавершенных запросов и закрывает соединения"""
+        self._read_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+        self._writer.close()
+
+
+db = AsyncDatabase()
+
+class Leaderboard:
+    """Рейтинг по тимбалам в памяти
+
+    Хранит отсортированный список (-тимбалы, user_id), поэтому топ - это
+    срез, а место пользователя ищется бинарным поиском. Обновляется из
+    потока писателя через Database.watch_balances, читается из event loop,
+    отсюда блокировка. Изменения приходят из триггера до коммита, поэтому
+    /top может недолго показывать баланс, который потом откатится; такие
+    расхождения убирает reconcile_stats_job.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._balls: Dict[int, int] = {}
+        self._order: List[tuple] = []
+
+    def load(self, rows: List[tuple]):
+        """Полностью пересобирает рейтинг из строк (user_id, team_balls)"""
+        balls = {user_id: team_balls or 0 for user_id, team_balls in rows}
+        order = sorted((-team_balls, user_id) for user_id, team_balls in balls.items())
+        with self._lock:
+            self._balls, self._order = balls, order
+
+    def update(self, user_id: int, team_balls: Optional[int], ranked: bool):
+        """Новый баланс пользователя; ranked=False убирает его из рейтинга"""
+        with self._lock:
+            old = self._balls.pop(user_id, None)
+            if old is not None:
+                del self._order[bisect.bisect_left(self._order, (-old, user_id))]
+            if ranked:
+                self._balls[user_id] = team_balls or 0
+                bisect.insort(self._order, (-(team_balls or 0), user_id))
+
+    def top(self, limit: int) -> List[tuple]:
+        """Первые limit участников: [(user_id, team_balls)]"""
+        with self._lock:
+            return [(user_id, -balls) for balls, user_id in self._order[:limit]]
+
+    def rank(self, user_id: int) -> Optional[tuple]:
+        """(место, тимбалы) пользователя или None, если его нет в рейтинге
+
+        При равных тимбалах место общее: 1 + число игроков с большим балансом.
+        """
+        with self._lock:
+            balls = self._balls.get(user_id)
+            if balls is None:
+                return None
+            return bisect.bisect_left(self._order, (-balls,)) + 1, balls
+
+    def __len__(self) -> int:
+        return len(self._balls)
+
+
+leaderboard = Leaderboard()
+
+
+class StateStore:
+    """Состояния диалогов пользователей с TTL и ограничением размера
+
+    Записи хранятся в OrderedDict в порядке последнего изменения. TTL у всех
+    записей одинаковый, поэтому и просроченные, и самые старые при
+    переполнении всегда лежат в начале и удаляются за O(1) каждая.
+    Если задан persist, изменения дублируются в базу, чтобы начатые
+    диалоги пережили перезапуск бота.
+    """
+
+    def __init__(self, ttl: int, max_entries: int, persist=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._persist = persist
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+
+    def _alive(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[user_id]
+            self.expired += 1
+            return None
+        return entry[1]
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._alive(user_id) is not None
+
+    def __getitem__(self, user_id: int) -> dict:
+        state = self._alive(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id: int, state: dict):
+        expires_at = int(time.time() + self.ttl)
+        self._entries[user_id] = (expires_at, state)
+        self._entries.move_to_end(user_id)
+        self.sweep()
+        if self._persist:
+            self._persist(user_id, state, expires_at)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int, default=None):
+        state = self._alive(user_id)
+        return default if state is None else state
+
+    def pop(self, user_id: int, default=None):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return default
+        if self._persist:
+            self._persist(user_id, None, 0)
+        return entry[1]
+
+    def sweep(self):
+        """Удаляет просроченные записи и самые старые сверх лимита"""
+        now = time.time()
+        while self._entries:
+            expires_at, _ = next(iter(self._entries.values()))
+            if expires_at > now:
+                break
+            self._entries.popitem(last=False)
+            self.expired += 1
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def load(self, rows: List[tuple]):
+        """Загружает сохраненные записи (user_id, state, expires_at) по возрастанию expires_at"""
+        for user_id, state, expires_at in rows:
+            self._entries[user_id] = (expires_at, state)
+            self._entries.move_to_end(user_id)
+        self.sweep()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики для мониторинга
+
+        approx_bytes - оценка по первым STATE_STATS_SAMPLE записям, умноженная
+        на их число, чтобы /stats не обходил весь словарь в цикле событий.
+        """
+        sample = list(itertools.islice(self._entries.values(), STATE_STATS_SAMPLE))
+        approx_bytes = sys.getsizeof(self._entries)
+        if sample:
+            sample_bytes = sum(sys.getsizeof(entry) + sys.getsizeof(entry[1])
+                               + sum(sys.getsizeof(value) for value in entry[1].values())
+                               for entry in sample)
+            approx_bytes += sample_bytes * len(self._entries) // len(sample)
+        return {
+            "entries": len(self._entries),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "approx_bytes": approx_bytes,
+        }
+
+
+def persist_user_state(user_id: int, state: Optional[dict], expires_at: int):
+    """Сохраняет состояние диалога в базу в фоне"""
+    db.submit_write(Database.save_user_state, user_id,
+                    json.dumps(state, ensure_ascii=False) if state is not None else None, expires_at)
 
-db = Database()
 
 # Состояния пользователей
-user_states = {}
+user_states = StateStore(STATE_TTL_SECONDS, STATE_MAX_ENTRIES,
+                         persist=persist_user_state if STATE_PERSIST else None)
+
+# Колоды поиска тиммейтов (не сохраняются, при перезапуске загрузятся заново)
+decks = StateStore(STATE_TTL_SECONDS, STATE_MAX_ENTRIES)
 
 
 # =========== ФУНКЦИИ ДЛЯ ПРОВЕРКИ ПРАВ ===========
@@ -433,11 +1968,192 @@ def is_admin_or_verifier(user_id: int) -> bool:
     return is_admin(user_id) or is_verifier(user_id)
 
 
+def unique_ids(*groups: List[int]) -> List[int]:
+    """Объединяет списки ID без повторов, сохраняя порядок"""
+    return list(dict.fromkeys(user_id for group in groups for user_id in group))
+
+
+def admin_recipients() -> List[int]:
+    """Все админы без повторов"""
+    return unique_ids(ADMIN_IDS, ADMIN_AND_VERIFIER_IDS)
+
+
+def verifier_recipients() -> List[int]:
+    """Все верификаторы без повторов"""
+    return unique_ids(VERIFIER_IDS, ADMIN_AND_VERIFIER_IDS)
+
+
 # ================================================
 
+# =========== РАССЫЛКА УВЕДОМЛЕНИЙ ===========
+class RateLimiter:
+    """Ограничивает частоту отправки: общую для бота и для каждого чата"""
+
+    def __init__(self, rate: float, per_chat_interval: float):
+        self.interval = 1 / rate
+        self.per_chat_interval = per_chat_interval
+        self._next_global = 0.0
+        self._next_chat: Dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        """Ждет, пока в чат можно будет отправить следующее сообщение"""
+        now = asyncio.get_running_loop().time()
+        global_slot = max(now, self._next_global)
+        slot = max(global_slot, self._next_chat.get(chat_id, 0.0))
+        self._next_global = global_slot + self.interval
+        self._next_chat[chat_id] = slot + self.per_chat_interval
+
+        if len(self._next_chat) > 1000:
+            self._next_chat = {cid: t for cid, t in self._next_chat.items() if t > now}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+notify_limiter = RateLimiter(NOTIFY_RATE_PER_SECOND, NOTIFY_PER_CHAT_INTERVAL)
+# Рассылки, которые еще идут
+notify_tasks = set()
+
+
+async def fan_out(bot, recipients: List[int], messages: List[tuple]) -> List[int]:
+    """Рассылает сообщения получателям параллельно с учетом лимитов Telegram
+
+    messages - список (метод бота, аргументы), например
+    ("send_message", {"text": "..."}); каждому получателю они уходят по порядку.
+    Возвращает ID получателей, которым не удалось доставить.
+    """
+    semaphore = asyncio.Semaphore(NOTIFY_MAX_CONCURRENCY)
+    failed = []
+
+    async def deliver(chat_id: int):
+        async with semaphore:
+            for method, kwargs in messages:
+                for attempt in range(2):
+                    await notify_limiter.wait(chat_id)
+                    try:
+                        await getattr(bot, method)(chat_id, **kwargs)
+                        break
+                    except RetryAfter as e:
+                        if attempt:
+                            raise
+                        await asyncio.sleep(e.retry_after.total_seconds()
+                                            if isinstance(e.retry_after, timedelta) else e.retry_after)
+
+    results = await asyncio.gather(*(deliver(chat_id) for chat_id in recipients), return_exceptions=True)
+    for chat_id, result in zip(recipients, results):
+        if isinstance(result, Exception):
+            failed.append(chat_id)
+            logger.error("Ошибка отправки уведомления %s: %s", chat_id, result)
+
+    logger.info("Рассылка: доставлено %d из %d", len(recipients) - len(failed), len(recipients))
+    return failed
+
+
+def notify_staff(context, recipients: List[int], messages: List[tuple]):
+    """Запускает рассылку в фоне, чтобы обработчик ответил пользователю сразу"""
+    task = context.application.create_task(fan_out(context.bot, recipients, messages))
+    notify_tasks.add(task)
+    task.add_done_callback(notify_tasks.discard)
+
+
+# ================================================
+
+# =========== ГОТОВЫЕ КЛАВИАТУРЫ И КАРТОЧКИ ===========
+# Объекты telegram неизменяемы, поэтому одну разметку можно отдавать во все ответы
+MAIN_MENU_TEXT = "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\nВыберите действие:"
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Моя анкета", callback_data="my_profile")],
+    [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="find_teammate")],
+    [InlineKeyboardButton("🤝 Найденные тиммейты", callback_data="found_teammates")],
+    [InlineKeyboardButton("🏪 Магазин", callback_data="shop")],
+    [InlineKeyboardButton("🔗 Реф ссылка", callback_data="referral")],
+    [InlineKeyboardButton("📞 Поддержка", callback_data="support")]
+])
+MENU_HINT_TEXT = "Ты можешь всегда нажать на кнопку '🏠 В меню' чтобы вернуться сюда"
+MENU_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("🏠 В меню")]], resize_keyboard=True)
+TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]])
+PROFILE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Изменить анкету", callback_data="edit_profile")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+])
+SHOP_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(f"{promo} робуксов - {price} тимбалов", callback_data=f"buy_{promo}")]
+     for promo, price in PROMO_CODES.items()]
+    + [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
+)
+
+
+def build_teammate_card(candidate: Candidate, mode: str):
+    """Собирает текст и кнопки карточки тиммейта"""
+    text = f"<b>👤 Никнейм:</b> {candidate.roblox_nickname}\n<b>🎮 Режимы:</b> {candidate.game_modes}\n\n"
+    if mode == "viewing_likes":
+        text += "<b>💡 Этот пользователь лайкнул вашу анкету!</b>\n"
+    text += f"<b>⭐ Найдено тиммейтов:</b> {candidate.matches_found}\n"
+
+    keyboard = [
+        [
+            InlineKeyboardButton("❤️ Лайк", callback_data=f"like_{candidate.user_id}"),
+            InlineKeyboardButton("💩 Дизлайк", callback_data=f"dislike_{candidate.user_id}")
+        ],
+        [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+class CardCache:
+    """Отрисованные карточки тиммейтов по user_id и версии анкеты
+
+    Версию поднимает каждое изменение анкеты через db (update_user_profile,
+    approve_profile, clear_profile и др.), так что устаревшая запись
+    просто не совпадет по версии и будет перерисована. Кроме версии
+    сверяются данные самой анкеты: счетчик найденных тиммейтов меняется
+    без правки анкеты. Записей не больше max_entries, вытесняются давно
+    не показанные.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, candidate: Candidate, mode: str):
+        """Возвращает (текст, кнопки) карточки, рисуя ее только при промахе"""
+        version = db.profile_version(candidate.user_id)
+        entry = self._entries.get(candidate.user_id)
+
+        if entry and entry[0] == version and entry[1] == candidate:
+            self._entries.move_to_end(candidate.user_id)
+            cards = entry[2]
+        else:
+            cards = {}
+            self._entries[candidate.user_id] = (version, candidate, cards)
+            self._entries.move_to_end(candidate.user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        card = cards.get(mode)
+        if card is None:
+            self.misses += 1
+            card = cards[mode] = build_teammate_card(candidate, mode)
+        else:
+            self.hits += 1
+        return card
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+card_cache = CardCache(CARD_CACHE_MAX_ENTRIES)
+
+
 def get_menu_keyboard():
-    """Создает клавиатуру с кнопкой 'В меню'"""
-    return ReplyKeyboardMarkup([[KeyboardButton("🏠 В меню")]], resize_keyboard=True)
+    """Клавиатура с кнопкой 'В меню'"""
+    return MENU_KEYBOARD
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -445,17 +2161,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
 
-    db.add_user(user_id, user.username)
+    await db.add_user(user_id, user.username)
 
     # Обработка реферальной ссылки
     if context.args:
         referrer_code = context.args[0]
-        cursor = db.conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referrer_code,))
-        referrer = cursor.fetchone()
+        referrer_id = await db.get_user_id_by_referral_code(referrer_code)
 
-        if referrer and referrer[0] != user_id:
-            db.add_referral(referrer[0], user_id)
+        if referrer_id and referrer_id != user_id:
+            await db.add_referral(referrer_id, user_id)
             await update.message.reply_text(
                 "🎉 Вы присоединились по реферальной ссылке! "
                 f"Найдите {REFERRAL_MATCHES_REQUIRED} тиммейтов, чтобы ваш друг получил награду.",
@@ -469,109 +2183,172 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает главное меню"""
     user_id = update.effective_user.id
 
-    profile = db.get_user_profile(user_id)
+    profile = await db.get_user_profile(user_id)
     if profile and profile[8]:  # is_banned
         await update.message.reply_text("❌ Вы забанены!", reply_markup=get_menu_keyboard())
         return
 
-    keyboard = [
-        [InlineKeyboardButton("👤 Моя анкета", callback_data="my_profile")],
-        [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="find_teammate")],
-        [InlineKeyboardButton("🤝 Найденные тиммейты", callback_data="found_teammates")],
-        [InlineKeyboardButton("🏪 Магазин", callback_data="shop")],
-        [InlineKeyboardButton("🔗 Реф ссылка", callback_data="referral")],
-        [InlineKeyboardButton("📞 Поддержка", callback_data="support")]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     if update.callback_query:
         await update.callback_query.edit_message_text(
-            "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\n"
-            "Выберите действие:",
+            MAIN_MENU_TEXT,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=MAIN_MENU_MARKUP
         )
     else:
         await update.message.reply_text(
-            "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\n"
-            "Выберите действие:",
+            MAIN_MENU_TEXT,
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
-        )
-        await update.message.reply_text(
-            "Ты можешь всегда нажать на кнопку '🏠 В меню' чтобы вернуться сюда",
-            reply_markup=get_menu_keyboard()
+            reply_markup=MAIN_MENU_MARKUP
         )
+        await update.message.reply_text(MENU_HINT_TEXT, reply_markup=MENU_KEYBOARD)
 
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
-    query = update.callback_query
-    await query.answer()
+class CallbackRoute(NamedTuple):
+    """Маршрут нажатия inline-кнопки"""
+    name: str
+    handler: object
+    arg_type: Optional[type]
+    answers: bool  # Обработчик сам отвечает на callback query
 
-    user_id = query.from_user.id
-    data = query.data
-
-    logger.info(f"Кнопка нажата: user_id={user_id}, data={data}")
-
-    if data == "my_profile":
-        logger.info(f"Показ профиля для {user_id}")
-        await show_my_profile(query, context)
-    elif data == "find_teammate":
-        logger.info(f"Поиск тиммейта для {user_id}")
-        await find_teammate(query, context)
-    elif data == "found_teammates":
-        await show_found_teammates(query, context)
-    elif data == "shop":
-        await show_shop(query, context)
-    elif data == "referral":
-        await show_referral_link(query, context)
-    elif data == "support":
-        await ask_support_message(query, context)
-    elif data.startswith("like_"):
-        await handle_like(query, context)
-    elif data.startswith("dislike_"):
-        await handle_dislike(query, context)
-    elif data.startswith("buy_"):
-        await handle_purchase(query, context)
-    elif data.startswith("approve_"):
-        await handle_approve_profile(query, context)
-    elif data.startswith("reject_"):
-        await handle_reject_profile(query, context)
-    elif data == "back_to_menu":
-        # Используем query для показа меню
-        keyboard = [
-            [InlineKeyboardButton("👤 Моя анкета", callback_data="my_profile")],
-            [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="find_teammate")],
-            [InlineKeyboardButton("🤝 Найденные тиммейты", callback_data="found_teammates")],
-            [InlineKeyboardButton("🏪 Магазин", callback_data="shop")],
-            [InlineKeyboardButton("🔗 Реф ссылка", callback_data="referral")],
-            [InlineKeyboardButton("📞 Поддержка", callback_data="support")]
-        ]
 
-        await query.edit_message_text(
-            "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\n"
-            "Выберите действие:",
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        await query.message.reply_text(
-            "Ты можешь всегда нажать на кнопку '🏠 В меню' чтобы вернуться сюда",
-            reply_markup=get_menu_keyboard()
-        )
-    elif data == "edit_profile":
-        await edit_profile(query, context)
-    elif data in ["cancel_message", "cancel_support"]:
-        await cancel_handler(update, context)
-    elif data.startswith("reply_"):
-        await handle_admin_reply(query, context)
+class RouteStats:
+    """Счетчики маршрута: вызовы, ошибки, время обработки"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms: float, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.calls if self.calls else 0.0
+
+
+class CallbackRouter:
+    """Маршрутизация нажатий inline-кнопок по таблице
+
+    Точные значения callback_data ищутся в одном словаре, префиксные
+    ("like_123") - в другом по части до первого "_", поэтому выбор
+    обработчика - O(1). Аргумент после префикса приводится к arg_type
+    и передается обработчику третьим параметром.
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, CallbackRoute] = {}
+        self._prefix: Dict[str, CallbackRoute] = {}
+        self.stats: Dict[str, RouteStats] = {}
+
+    def exact(self, data: str, handler, answers: bool = False):
+        self._exact[data] = CallbackRoute(data, handler, None, answers)
+        self.stats[data] = RouteStats()
+
+    def prefix(self, prefix: str, handler, arg_type: type = str, answers: bool = False):
+        if not prefix.endswith("_") or "_" in prefix[:-1]:
+            raise ValueError(f"Префикс должен заканчиваться единственным '_': {prefix}")
+        self._prefix[prefix] = CallbackRoute(prefix, handler, arg_type, answers)
+        self.stats[prefix] = RouteStats()
+
+    def resolve(self, data: str):
+        """Возвращает (маршрут, аргумент) или (None, None)"""
+        route = self._exact.get(data)
+        if route:
+            return route, None
+
+        head, separator, tail = data.partition("_")
+        route = self._prefix.get(head + separator) if separator else None
+        if route:
+            return route, tail
+        return None, None
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик нажатий на кнопки"""
+        query = update.callback_query
+        data = query.data or ""
+
+        log_event("button", "Кнопка нажата", user_id=query.from_user.id, data=data)
+
+        route, arg = self.resolve(data)
+        if route is None:
+            logger.warning("Неизвестная кнопка: %s", data)
+            await query.answer()
+            return
+
+        if not route.answers:
+            await query.answer()
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            if route.arg_type is None:
+                await route.handler(query, context)
+            else:
+                await route.handler(query, context, route.arg_type(arg))
+        except Exception:
+            failed = True
+            metrics.inc("bot_handler_errors_total", handler=route.handler.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stats[route.name].record(elapsed * 1000, failed)
+            metrics.observe("bot_handler_seconds", elapsed, handler=route.handler.__name__)
+
+
+async def replace_message_text(query, text: str, reply_markup):
+    """Заменяет сообщение с кнопками текстом
+
+    Сообщение с фото нельзя отредактировать в текстовое, поэтому вместо
+    него отправляется новое, а старое удаляется.
+    """
+    if query.message.photo:
+        await query.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        await query.delete_message()
+    else:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+async def back_to_menu(query, context):
+    """Возвращает в главное меню из inline-сообщения"""
+    await replace_message_text(query, MAIN_MENU_TEXT, MAIN_MENU_MARKUP)
+    await query.message.reply_text(MENU_HINT_TEXT, reply_markup=MENU_KEYBOARD)
+
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /top - топ-10 игроков и место пользователя"""
+    user_id = update.effective_user.id
+    top_users = leaderboard.top(10)
+
+    if not top_users:
+        await update.message.reply_text("📭 Рейтинг пока пуст", reply_markup=get_menu_keyboard())
+        return
+
+    names = await db.get_users_brief([uid for uid, _ in top_users])
+    text = "<b>🏆 Топ-10 игроков по тимбалам:</b>\n\n"
+
+    for i, (uid, team_balls) in enumerate(top_users, 1):
+        medal = "🥇" if i == 1 else ("🥈" if i == 2 else ("🥉" if i == 3 else f"{i}."))
+        roblox_nick = names.get(uid, (None, None))[1]
+        text += f"{medal} <b>{roblox_nick or 'нет ника'}</b> - {team_balls} тимбалов\n"
+
+    rank = leaderboard.rank(user_id)
+    if rank:
+        text += f"\n<b>📍 Ваше место:</b> {rank[0]} из {len(leaderboard)} ({rank[1]} тимбалов)"
+    else:
+        text += "\n📍 Чтобы попасть в рейтинг, нужна одобренная анкета"
+
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=get_menu_keyboard())
 
 
 async def show_my_profile(query, context):
     """Показывает профиль пользователя"""
     user_id = query.from_user.id
-    profile = db.get_user_profile(user_id)
+    profile = await db.get_user_profile(user_id)
 
     if not profile or not profile[2]:  # Нет roblox_nickname
         # Нет анкеты - создаем новую
@@ -585,19 +2362,8 @@ async def show_my_profile(query, context):
         return
 
     # Показываем статистику профиля
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM interactions WHERE to_user_id = ? AND is_like = 1', (user_id,))
-    likes_count = cursor.fetchone()[0]
-
-    cursor.execute('''
-        SELECT u.username, u.team_balls, i.message, i.sent_at
-        FROM interactions i
-        JOIN users u ON i.from_user_id = u.user_id
-        WHERE i.to_user_id = ? AND i.is_like = 1
-        ORDER BY i.sent_at DESC LIMIT 10
-    ''', (user_id,))
-
-    messages = cursor.fetchall()
+    likes_count = profile[14]  # likes_received
+    messages = await db.get_recent_like_messages(user_id, 10)
 
     verification_status = ""
     if profile[5] == 0:
@@ -614,14 +2380,14 @@ async def show_my_profile(query, context):
     text += f"<b>📊 Статус:</b> {verification_status}\n"
     text += f"<b>⭐ Лайков:</b> {likes_count}\n"
     text += f"<b>💰 Тимбалов:</b> {profile[6]}\n"
-    text += f"<b>🔍 Найдено тиммейтов:</b> {profile[12]}\n"
+    text += f"<b>🔍 Найдено тиммейтов:</b> {profile[11]}\n"
     text += f"<b>⚠️ Предупреждений:</b> {profile[7]}/3\n\n"
 
     if messages:
         text += "<b>📬 Последние сообщения:</b>\n"
         for msg in messages:
             username, balls, message, sent_at = msg
-            time_str = datetime.fromisoformat(sent_at).strftime("%d.%m %H:%M") if sent_at else ""
+            time_str = datetime.fromtimestamp(sent_at).strftime("%d.%m %H:%M") if sent_at else ""
 
             # Экранируем HTML символы
             safe_message = message.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
@@ -631,14 +2397,10 @@ async def show_my_profile(query, context):
             text += f"├ <b>Сообщение:</b> {safe_message[:50]}{'...' if len(message) > 50 else ''}\n"
             text += f"└ <b>Время:</b> {time_str}\n\n"
 
-    keyboard = []
-    keyboard.append([InlineKeyboardButton("✏️ Изменить анкету", callback_data="edit_profile")])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-
     await query.edit_message_text(
         text,
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=PROFILE_MARKUP
     )
 
 
@@ -655,15 +2417,48 @@ async def edit_profile(query, context):
     )
 
 
+async def show_teammate_card(query, deck: dict, candidate: Candidate):
+    """Показывает карточку тиммейта вместо текущего сообщения
+
+    Между карточками с фото сообщение редактируется на месте одним
+    вызовом edit_message_media, между текстовыми - edit_message_text.
+    Переход между текстом и фото в Bot API не редактируется, в этом
+    случае сообщение отправляется заново.
+    """
+    text, reply_markup = card_cache.render(candidate, deck["mode"])
+
+    try:
+        if candidate.photo_id and query.message.photo:
+            await query.edit_message_media(
+                InputMediaPhoto(candidate.photo_id, caption=text, parse_mode=ParseMode.HTML),
+                reply_markup=reply_markup
+            )
+        elif candidate.photo_id:
+            await query.message.reply_photo(
+                photo=candidate.photo_id,
+                caption=text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=reply_markup
+            )
+            await query.delete_message()
+        else:
+            await replace_message_text(query, text, reply_markup)
+    except Exception as e:
+        if isinstance(e, BadRequest) and "not modified" in str(e):
+            return  # Та же карточка уже на экране
+        logger.error("Ошибка при показе тиммейта: %s", e)
+        await replace_message_text(query, text + "\n<b>🖼 Фото:</b> (не удалось загрузить)\n", reply_markup)
+
+
 async def find_teammate(query, context):
     """Ищет тиммейтов для пользователя"""
     user_id = query.from_user.id
-    profile = db.get_user_profile(user_id)
+    profile = await db.get_user_profile(user_id)
 
     if not profile or not profile[2]:  # Нет ника в Roblox
         await query.edit_message_text(
             "❌ Сначала создайте анкету!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]])
+            reply_markup=TO_MENU_MARKUP
         )
         return
 
@@ -675,300 +2470,118 @@ async def find_teammate(query, context):
         }
         await query.edit_message_text(
             status_text.get(profile[5], "❌ Произошла ошибка"),
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]])
+            reply_markup=TO_MENU_MARKUP
         )
         return
 
+    # Запоминаем номер изменений до загрузки, чтобы потом отсеять устаревшие карточки
+    generation = db.profile_generation
+
     # Сначала проверяем, есть ли пользователи, которые лайкнули текущего пользователя
-    liked_users = db.find_likes_for_user(user_id)
+    deck = await db.find_likes_for_user(user_id)
+    mode = "viewing_likes"
 
-    if liked_users:
-        # Показываем тех, кто лайкнул пользователя
-        context.user_data["current_mode"] = "viewing_likes"
-        context.user_data["teammates_list"] = [t[0] for t in liked_users]
-        context.user_data["current_teammate_index"] = 0
+    if not deck:
+        # Если нет лайков, показываем случайных тиммейтов
+        deck = await db.find_random_teammates(user_id)
+        mode = "viewing_random"
 
-        teammate = liked_users[0]
-        context.user_data["current_teammate"] = teammate[0]
+    if not deck:
+        metrics.inc("bot_deck_exhausted_total", reason="empty")
+        await query.edit_message_text(
+            "😔 Пока нет подходящих тиммейтов. Попробуйте позже!",
+            reply_markup=TO_MENU_MARKUP
+        )
+        return
 
-        text = f"<b>👤 Никнейм:</b> {teammate[2]}\n"
-        text += f"<b>🎮 Режимы:</b> {teammate[4]}\n\n"
-        text += f"<b>💡 Этот пользователь лайкнул вашу анкету!</b>\n"
-        text += f"<b>⭐ Найдено тиммейтов:</b> {teammate[12]}\n"
+    user_deck = {"mode": mode, "cards": deck, "generation": generation}
+    decks[user_id] = user_deck
 
-        keyboard_buttons = [
-            [
-                InlineKeyboardButton("❤️ Лайк", callback_data=f"like_{teammate[0]}"),
-                InlineKeyboardButton("💩 Дизлайк", callback_data=f"dislike_{teammate[0]}")
-            ],
-            [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-        ]
+    await show_teammate_card(query, user_deck, deck[0])
 
-        try:
-            if teammate[3]:
-                await query.message.reply_photo(
-                    photo=teammate[3],
-                    caption=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                )
-                await query.delete_message()
-            else:
-                await query.edit_message_text(
-                    text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                )
-        except Exception as e:
-            logger.error(f"Ошибка при показе тиммейта: {e}")
-            await query.edit_message_text(
-                text + "\n<b>🖼 Фото:</b> (не удалось загрузить)\n",
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-            )
-    else:
-        # Если нет лайков, показываем случайных тиммейтов
-        random_teammates = db.find_random_teammates(user_id)
 
-        if not random_teammates:
-            await query.edit_message_text(
-                "😔 Пока нет подходящих тиммейтов. Попробуйте позже!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]])
-            )
-            return
+async def next_deck_candidate(deck: dict) -> Optional[Candidate]:
+    """Берет следующую анкету из колоды.
 
-        context.user_data["current_mode"] = "viewing_random"
-        context.user_data["teammates_list"] = [t[0] for t in random_teammates]
-        context.user_data["current_teammate_index"] = 0
+    Анкеты, измененные после загрузки колоды (бан, повторная проверка),
+    перечитываются из базы, остальные показываются без запросов.
+    """
+    cards = deck["cards"]
 
-        teammate = random_teammates[0]
-        context.user_data["current_teammate"] = teammate[0]
+    while cards:
+        if db.profile_version(cards[0].user_id) <= deck["generation"]:
+            return cards[0]
 
-        text = f"<b>👤 Никнейм:</b> {teammate[2]}\n"
-        text += f"<b>🎮 Режимы:</b> {teammate[4]}\n\n"
-        text += f"<b>💡 Найдено тиммейтов:</b> {teammate[12]}\n"
+        fresh = await db.get_candidate(cards[0].user_id)
+        if fresh:
+            cards[0] = fresh
+            return fresh
+        cards.pop(0)
 
-        keyboard = [
-            [
-                InlineKeyboardButton("❤️ Лайк", callback_data=f"like_{teammate[0]}"),
-                InlineKeyboardButton("💩 Дизлайк", callback_data=f"dislike_{teammate[0]}")
-            ],
-            [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-        ]
+    return None
 
-        try:
-            if teammate[3]:
-                await query.message.reply_photo(
-                    photo=teammate[3],
-                    caption=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                await query.delete_message()
-            else:
-                await query.edit_message_text(
-                    text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-        except Exception as e:
-            logger.error(f"Ошибка при показе тиммейта: {e}")
-            await query.edit_message_text(
-                text + "\n<b>🖼 Фото:</b> (не удалось загрузить)\n",
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+
+async def show_next_teammate(query, context, swiped_user_id: int):
+    """Убирает оцененную анкету из колоды и показывает следующую"""
+    deck = decks.get(query.from_user.id)
+
+    if deck:
+        deck["cards"] = [c for c in deck["cards"] if c.user_id != swiped_user_id]
+        candidate = await next_deck_candidate(deck)
+        if candidate:
+            await show_teammate_card(query, deck, candidate)
+            return
+        decks.pop(query.from_user.id)
+        metrics.inc("bot_deck_exhausted_total", reason="swiped_all")
+
+    # Если больше нет пользователей в списке
+    await replace_message_text(query, "🎉 Вы просмотрели всех пользователей!\n\n" + MAIN_MENU_TEXT, MAIN_MENU_MARKUP)
+    await query.message.reply_text(MENU_HINT_TEXT, reply_markup=MENU_KEYBOARD)
 
 
-async def handle_like(query, context):
+async def handle_like(query, context, to_user_id: int):
     """Обрабатывает лайк"""
     user_id = query.from_user.id
-    to_user_id = int(query.data.split("_")[1])
 
-    db.add_interaction(user_id, to_user_id, True)
+    await db.add_interaction(user_id, to_user_id, True)
 
     # Отправляем уведомление пользователю, которого лайкнули
     try:
-        profile = db.get_user_profile(user_id)
+        username = query.from_user.username
         await context.bot.send_message(
             to_user_id,
             f"💖 <b>Вас лайкнули!</b>\n\n"
-            f"Пользователь <b>@{profile[1] if profile[1] else 'без username'}</b> оценил вашу анкету!\n"
+            f"Пользователь <b>@{username if username else 'без username'}</b> оценил вашу анкету!\n"
             f"Теперь вы можете найти его в разделе '🔍 Искать тиммейта'.",
             parse_mode=ParseMode.HTML
         )
     except Exception as e:
-        logger.error(f"Ошибка отправки уведомления: {e}")
+        logger.error("Ошибка отправки уведомления: %s", e)
 
     await query.answer(f"✅ Лайк отправлен! +{TEAMBALLS_PER_MATCH} тимбалов")
 
-    # Удаляем пользователя из списка
-    teammates_list = context.user_data.get("teammates_list", [])
-    current_mode = context.user_data.get("current_mode", "viewing_random")
-
-    if teammates_list:
-        teammates_list = [tid for tid in teammates_list if tid != to_user_id]
-        context.user_data["teammates_list"] = teammates_list
+    await show_next_teammate(query, context, to_user_id)
 
-        if teammates_list:
-            # Показываем следующего пользователя
-            next_teammate_id = teammates_list[0]
-            teammate = db.get_user_profile(next_teammate_id)
 
-            if teammate:
-                context.user_data["current_teammate"] = teammate[0]
-                text = f"<b>👤 Никнейм:</b> {teammate[2]}\n<b>🎮 Режимы:</b> {teammate[4]}\n\n"
-
-                if current_mode == "viewing_likes":
-                    text += f"<b>💡 Этот пользователь лайкнул вашу анкету!</b>\n"
-                text += f"<b>⭐ Найдено тиммейтов:</b> {teammate[12]}\n"
-
-                keyboard_buttons = [
-                    [
-                        InlineKeyboardButton("❤️ Лайк", callback_data=f"like_{teammate[0]}"),
-                        InlineKeyboardButton("💩 Дизлайк", callback_data=f"dislike_{teammate[0]}")
-                    ],
-                    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-                ]
-
-                try:
-                    if teammate[3]:
-                        await query.message.reply_photo(
-                            photo=teammate[3],
-                            caption=text,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                        )
-                        await query.delete_message()
-                    else:
-                        await query.edit_message_text(
-                            text,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                        )
-                except:
-                    await query.edit_message_text(
-                        text + "\n<b>🖼 Фото:</b> (не удалось загрузить)\n",
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                    )
-                return
-
-    # Если больше нет пользователей в списке
-    keyboard = [
-        [InlineKeyboardButton("👤 Моя анкета", callback_data="my_profile")],
-        [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="find_teammate")],
-        [InlineKeyboardButton("🤝 Найденные тиммейты", callback_data="found_teammates")],
-        [InlineKeyboardButton("🏪 Магазин", callback_data="shop")],
-        [InlineKeyboardButton("🔗 Реф ссылка", callback_data="referral")],
-        [InlineKeyboardButton("📞 Поддержка", callback_data="support")]
-    ]
-
-    await query.edit_message_text(
-        "🎉 Вы просмотрели всех пользователей!\n\n"
-        "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\n"
-        "Выберите действие:",
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    await query.message.reply_text(
-        "Ты можешь всегда нажать на кнопку '🏠 В меню' чтобы вернуться сюда",
-        reply_markup=get_menu_keyboard()
-    )
-
-
-async def handle_dislike(query, context):
+async def handle_dislike(query, context, to_user_id: int):
     """Обрабатывает дизлайк"""
     user_id = query.from_user.id
-    to_user_id = int(query.data.split("_")[1])
 
-    db.add_interaction(user_id, to_user_id, False)
+    await db.add_interaction(user_id, to_user_id, False)
     await query.answer("💩 Дизлайк отправлен")
 
-    # Удаляем пользователя из списка
-    teammates_list = context.user_data.get("teammates_list", [])
-    current_mode = context.user_data.get("current_mode", "viewing_random")
-
-    if teammates_list:
-        teammates_list = [tid for tid in teammates_list if tid != to_user_id]
-        context.user_data["teammates_list"] = teammates_list
-
-        if teammates_list:
-            # Показываем следующего пользователя
-            next_teammate_id = teammates_list[0]
-            teammate = db.get_user_profile(next_teammate_id)
-
-            if teammate:
-                context.user_data["current_teammate"] = teammate[0]
-                text = f"<b>👤 Никнейм:</b> {teammate[2]}\n<b>🎮 Режимы:</b> {teammate[4]}\n\n"
-
-                if current_mode == "viewing_likes":
-                    text += f"<b>💡 Этот пользователь лайкнул вашу анкету!</b>\n"
-                text += f"<b>⭐ Найдено тиммейтов:</b> {teammate[12]}\n"
-
-                keyboard_buttons = [
-                    [
-                        InlineKeyboardButton("❤️ Лайк", callback_data=f"like_{teammate[0]}"),
-                        InlineKeyboardButton("💩 Дизлайк", callback_data=f"dislike_{teammate[0]}")
-                    ],
-                    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-                ]
-
-                try:
-                    if teammate[3]:
-                        await query.message.reply_photo(
-                            photo=teammate[3],
-                            caption=text,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                        )
-                        await query.delete_message()
-                    else:
-                        await query.edit_message_text(
-                            text,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                        )
-                except:
-                    await query.edit_message_text(
-                        text + "\n<b>🖼 Фото:</b> (не удалось загрузить)\n",
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-                    )
-                return
-
-    # Если больше нет пользователей в списке
-    keyboard = [
-        [InlineKeyboardButton("👤 Моя анкета", callback_data="my_profile")],
-        [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="find_teammate")],
-        [InlineKeyboardButton("🤝 Найденные тиммейты", callback_data="found_teammates")],
-        [InlineKeyboardButton("🏪 Магазин", callback_data="shop")],
-        [InlineKeyboardButton("🔗 Реф ссылка", callback_data="referral")],
-        [InlineKeyboardButton("📞 Поддержка", callback_data="support")]
-    ]
-
-    await query.edit_message_text(
-        "🎉 Вы просмотрели всех пользователей!\n\n"
-        "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\n"
-        "Выберите действие:",
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    await query.message.reply_text(
-        "Ты можешь всегда нажать на кнопку '🏠 В меню' чтобы вернуться сюда",
-        reply_markup=get_menu_keyboard()
-    )
+    await show_next_teammate(query, context, to_user_id)
 
 
 async def show_found_teammates(query, context):
     """Показывает найденных тиммейтов (историю лайков)"""
     user_id = query.from_user.id
-    interactions = db.get_user_interactions(user_id)
+    interactions = await db.get_user_interactions(user_id)
 
     if not interactions:
         await query.edit_message_text(
             "😔 Пока вас никто не лайкнул",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]])
+            reply_markup=BACK_MARKUP
         )
         return
 
@@ -979,7 +2592,7 @@ async def show_found_teammates(query, context):
         username = interaction[1]
         roblox_nick = interaction[2]
         game_modes = interaction[4]
-        message = interaction[13]
+        message = interaction[5]
 
         # Экранируем HTML символы
         safe_username = username.replace("&", "&amp;").replace("<", "&lt;").replace(">",
@@ -996,65 +2609,57 @@ async def show_found_teammates(query, context):
     await query.edit_message_text(
         text,
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]])
+        reply_markup=BACK_MARKUP
     )
 
 
 async def show_shop(query, context):
     """Показывает магазин"""
     user_id = query.from_user.id
-    profile = db.get_user_profile(user_id)
+    profile = await db.get_user_profile(user_id)
     team_balls = profile[6] if profile else 0
 
     text = f"<b>🏪 Магазин</b>\n\n<b>💰 Ваши тимбаллы:</b> {team_balls}\n\nВыберите промокод:\n\n"
 
-    keyboard = []
-    for promo, price in PROMO_CODES.items():
-        keyboard.append([InlineKeyboardButton(f"{promo} робуксов - {price} тимбалов", callback_data=f"buy_{promo}")])
-
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-
     await query.edit_message_text(
         text,
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=SHOP_MARKUP
     )
 
 
-async def handle_purchase(query, context):
+async def handle_purchase(query, context, promo_type: str):
     """Обрабатывает покупку промокода"""
     user_id = query.from_user.id
-    promo_type = query.data.split("_")[1]
-    price = PROMO_CODES[promo_type]
+    price = PROMO_CODES.get(promo_type)
 
-    profile = db.get_user_profile(user_id)
+    if price is None:
+        await query.answer("❌ Такого промокода нет")
+        return
+
+    profile = await db.get_user_profile(user_id)
     if not profile:
         await query.answer("❌ Ошибка: профиль не найден")
         return
 
-    if profile[6] < price:
+    # Проверка баланса и списание - одним запросом, чтобы не уйти в минус
+    if not await db.purchase_promo(user_id, promo_type, price):
         await query.answer(f"❌ Недостаточно тимбалов! Нужно: {price}")
         return
 
-    db.add_team_balls(user_id, -price)
-    db.add_purchase(user_id, promo_type, price)
-
     await query.answer(f"✅ Покупка успешна! Промокод на {promo_type} робуксов приобретен.")
 
-    for admin_id in ADMIN_IDS + ADMIN_AND_VERIFIER_IDS:
-        try:
-            await context.bot.send_message(
-                admin_id,
-                f"<b>🛒 Новая покупка!</b>\n\n"
-                f"<b>Пользователь:</b> @{profile[1] if profile[1] else 'нет'}\n"
-                f"<b>ID:</b> {user_id}\n"
-                f"<b>Промокод:</b> {promo_type} робуксов\n"
-                f"<b>Стоимость:</b> {price} тимбалов\n"
-                f"<a href='tg://user?id={user_id}'>Ссылка</a>",
-                parse_mode=ParseMode.HTML
-            )
-        except:
-            pass
+    notify_staff(context, admin_recipients(), [
+        ("send_message", {
+            "text": f"<b>🛒 Новая покупка!</b>\n\n"
+                    f"<b>Пользователь:</b> @{profile[1] if profile[1] else 'нет'}\n"
+                    f"<b>ID:</b> {user_id}\n"
+                    f"<b>Промокод:</b> {promo_type} робуксов\n"
+                    f"<b>Стоимость:</b> {price} тимбалов\n"
+                    f"<a href='tg://user?id={user_id}'>Ссылка</a>",
+            "parse_mode": ParseMode.HTML
+        })
+    ])
 
     await show_shop(query, context)
 
@@ -1062,7 +2667,7 @@ async def handle_purchase(query, context):
 async def show_referral_link(query, context):
     """Показывает реферальную ссылку"""
     user_id = query.from_user.id
-    profile = db.get_user_profile(user_id)
+    profile = await db.get_user_profile(user_id)
 
     if not profile:
         await query.answer("❌ Ошибка: профиль не найден")
@@ -1072,9 +2677,7 @@ async def show_referral_link(query, context):
     bot_username = context.bot.username
     referral_link = f"https://t.me/{bot_username}?start={referral_code}"
 
-    cursor = db.conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND completed = 1', (user_id,))
-    completed_refs = cursor.fetchone()[0]
+    completed_refs = profile[15]  # referrals_completed
 
     text = f"<b>🔗 Ваша реферальная ссылка:</b>\n\n<code>{referral_link}</code>\n\n"
     text += f"<b>📊 Статистика:</b>\n• Приглашено друзей: {completed_refs}\n"
@@ -1084,7 +2687,7 @@ async def show_referral_link(query, context):
     await query.edit_message_text(
         text,
         parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]])
+        reply_markup=BACK_MARKUP
     )
 
 
@@ -1107,8 +2710,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Обработка кнопки "В меню"
     if message_text == "🏠 В меню":
-        if user_id in user_states:
-            del user_states[user_id]
+        user_states.pop(user_id)
         if "message_for_user" in context.user_data:
             del context.user_data["message_for_user"]
         if "replying_to" in context.user_data:
@@ -1116,9 +2718,9 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_main_menu(update, context)
         return
 
-    if user_id in user_states:
-        state_data = user_states[user_id]
+    state_data = user_states.get(user_id)
 
+    if state_data:
         if state_data["state"] == "waiting_nickname":
             if len(message_text.strip()) < 2:
                 await update.message.reply_text(
@@ -1127,8 +2729,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            context.user_data["roblox_nickname"] = message_text.strip()
-            user_states[user_id] = {"state": "waiting_photo"}
+            user_states[user_id] = {"state": "waiting_photo", "roblox_nickname": message_text.strip()}
             await update.message.reply_text(
                 "📸 Теперь отправьте фото вашего скина в Roblox:\n\n"
                 "Нажмите '🏠 В меню' для отмены",
@@ -1143,60 +2744,31 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            context.user_data["game_modes"] = message_text.strip()
-
             # Получаем сохраненные данные
-            roblox_nickname = context.user_data.get("roblox_nickname", "")
-            photo_id = context.user_data.get("photo_id", "")
+            roblox_nickname = state_data.get("roblox_nickname", "")
+            photo_id = state_data.get("photo_id", "")
 
-            db.update_user_profile(
+            await db.update_user_profile(
                 user_id=user_id,
                 roblox_nickname=roblox_nickname,
                 photo_id=photo_id,
                 game_modes=message_text.strip()
             )
 
-            # Отправляем верификаторам
-            for verifier_id in VERIFIER_IDS + ADMIN_AND_VERIFIER_IDS:
-                try:
-                    text = f"<b>📝 Новая анкета на проверку!</b>\n\n"
-                    text += f"<b>Пользователь:</b> @{update.effective_user.username or 'нет'}\n"
-                    text += f"<b>ID:</b> {user_id}\n"
-                    text += f"<b>Ник в Roblox:</b> {roblox_nickname}\n"
-                    text += f"<b>Режимы:</b> {message_text.strip()}"
-
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_{user_id}"),
-                            InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{user_id}")
-                        ]
-                    ]
-
-                    await context.bot.send_message(
-                        verifier_id,
-                        text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-
-                    if photo_id:
-                        await context.bot.send_photo(
-                            verifier_id,
-                            photo=photo_id,
-                            caption="Фото скина"
-                        )
-                except Exception as e:
-                    logger.error(f"Ошибка отправки верификатору {verifier_id}: {e}")
+            # Сообщаем верификаторам о новой анкете. Кнопки не рассылаем:
+            # анкету получит тот, кто заберет ее из очереди через /verifications
+            stats = await db.get_stats()
+            text = (f"<b>📝 Новая анкета на проверку!</b>\n\n"
+                    f"<b>В очереди:</b> {stats.get('pending_users', 0)}\n"
+                    f"Взять анкеты: /verifications")
+
+            notify_staff(context, verifier_recipients(), [("send_message", {
+                "text": text,
+                "parse_mode": ParseMode.HTML
+            })])
 
             # Очищаем временные данные
-            if user_id in user_states:
-                del user_states[user_id]
-            if "roblox_nickname" in context.user_data:
-                del context.user_data["roblox_nickname"]
-            if "photo_id" in context.user_data:
-                del context.user_data["photo_id"]
-            if "game_modes" in context.user_data:
-                del context.user_data["game_modes"]
+            user_states.pop(user_id)
 
             await update.message.reply_text(
                 "✅ Анкета отправлена на модерацию! Ожидайте проверки.",
@@ -1207,33 +2779,29 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         elif state_data["state"] == "waiting_support":
             if len(message_text) <= 500:
-                db.add_support_message(user_id, message_text)
-
-                for admin_id in ADMIN_IDS + ADMIN_AND_VERIFIER_IDS:
-                    try:
-                        # Экранируем HTML символы
-                        safe_message = message_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-                        await context.bot.send_message(
-                            admin_id,
-                            f"<b>📩 Новое сообщение в поддержку!</b>\n\n"
-                            f"<b>От:</b> @{update.effective_user.username or 'нет'}\n"
-                            f"<b>ID:</b> {user_id}\n\n"
-                            f"<b>Сообщение:</b> {safe_message}",
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("💌 Ответить", callback_data=f"reply_{user_id}")]
-                            ])
-                        )
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки админу {admin_id}: {e}")
+                await db.add_support_message(user_id, message_text)
+
+                # Экранируем HTML символы
+                safe_message = message_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+                notify_staff(context, admin_recipients(), [
+                    ("send_message", {
+                        "text": f"<b>📩 Новое сообщение в поддержку!</b>\n\n"
+                                f"<b>От:</b> @{update.effective_user.username or 'нет'}\n"
+                                f"<b>ID:</b> {user_id}\n\n"
+                                f"<b>Сообщение:</b> {safe_message}",
+                        "parse_mode": ParseMode.HTML,
+                        "reply_markup": InlineKeyboardMarkup([
+                            [InlineKeyboardButton("💌 Ответить", callback_data=f"reply_{user_id}")]
+                        ])
+                    })
+                ])
 
                 await update.message.reply_text(
                     "✅ Ваше сообщение отправлено в поддержку!",
                     reply_markup=get_menu_keyboard()
                 )
-                if user_id in user_states:
-                    del user_states[user_id]
+                user_states.pop(user_id)
                 # Показываем главное меню
                 await show_main_menu(update, context)
             else:
@@ -1273,12 +2841,12 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик фото"""
     user_id = update.effective_user.id
 
-    if user_id in user_states and user_states[user_id]["state"] == "waiting_photo":
+    state_data = user_states.get(user_id)
+    if state_data and state_data["state"] == "waiting_photo":
         # Получаем file_id фото (самое большое фото)
         photo_file_id = update.message.photo[-1].file_id
-        context.user_data["photo_id"] = photo_file_id  # Сохраняем file_id
 
-        user_states[user_id] = {"state": "waiting_game_modes"}
+        user_states[user_id] = {**state_data, "state": "waiting_game_modes", "photo_id": photo_file_id}
 
         await update.message.reply_text(
             "🎮 Теперь введите игровые режимы, в которые вы играете (через запятую):\n"
@@ -1307,7 +2875,7 @@ async def admin_give(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_arg = context.args[1]
             if target_arg.startswith('@'):
                 username = target_arg[1:]
-                target_id = db.get_user_by_username(username)
+                target_id = await db.get_user_by_username(username)
                 if not target_id:
                     await update.message.reply_text("❌ Пользователь не найден")
                     return
@@ -1319,7 +2887,7 @@ async def admin_give(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Укажите пользователя")
             return
 
-        if db.add_team_balls(target_id, amount):
+        if await db.add_team_balls(target_id, amount):
             await update.message.reply_text(f"✅ Пользователю {target_id} выдано {amount} тимбалов")
 
             try:
@@ -1333,7 +2901,7 @@ async def admin_give(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный формат числа")
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
-        logger.error(f"Ошибка в admin_give: {e}")
+        logger.error("Ошибка в admin_give: %s", e)
 
 
 async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1346,7 +2914,7 @@ async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_arg = context.args[0]
             if target_arg.startswith('@'):
                 username = target_arg[1:]
-                target_id = db.get_user_by_username(username)
+                target_id = await db.get_user_by_username(username)
                 if not target_id:
                     await update.message.reply_text("❌ Пользователь не найден")
                     return
@@ -1358,9 +2926,7 @@ async def admin_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Укажите пользователя")
             return
 
-        cursor = db.conn.cursor()
-        cursor.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (target_id,))
-        db.conn.commit()
+        await db.set_banned(target_id, True)
 
         await update.message.reply_text(f"✅ Пользователь {target_id} забанен")
 
@@ -1383,7 +2949,7 @@ async def admin_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_arg = context.args[0]
             if target_arg.startswith('@'):
                 username = target_arg[1:]
-                target_id = db.get_user_by_username(username)
+                target_id = await db.get_user_by_username(username)
                 if not target_id:
                     await update.message.reply_text("❌ Пользователь не найден")
                     return
@@ -1395,9 +2961,7 @@ async def admin_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Укажите пользователя")
             return
 
-        cursor = db.conn.cursor()
-        cursor.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (target_id,))
-        db.conn.commit()
+        await db.set_banned(target_id, False)
 
         await update.message.reply_text(f"✅ Пользователь {target_id} разбанен")
 
@@ -1423,7 +2987,7 @@ async def admin_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_arg = context.args[0]
         if target_arg.startswith('@'):
             username = target_arg[1:]
-            target_id = db.get_user_by_username(username)
+            target_id = await db.get_user_by_username(username)
         else:
             try:
                 target_id = int(target_arg)
@@ -1431,16 +2995,10 @@ async def admin_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
 
     if target_id:
-        cursor = db.conn.cursor()
-        cursor.execute('SELECT warnings FROM users WHERE user_id = ?', (target_id,))
-        result = cursor.fetchone()
-
-        if result:
-            warnings = result[0] + 1
-            cursor.execute('UPDATE users SET warnings = ? WHERE user_id = ?', (warnings, target_id))
+        warnings = await db.add_warning(target_id)
 
+        if warnings is not None:
             if warnings >= 3:
-                cursor.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (target_id,))
                 await update.message.reply_text(
                     f"⚠️ Пользователь {target_id} получил предупреждение ({warnings}/3). Достигнут лимит - забанен!")
 
@@ -1457,7 +3015,6 @@ async def admin_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 except:
                     pass
 
-            db.conn.commit()
             return
 
     await update.message.reply_text("❌ Ответьте на сообщение пользователя или используйте: /warn [@username или id]")
@@ -1476,7 +3033,7 @@ async def admin_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_arg = context.args[0]
         if target_arg.startswith('@'):
             username = target_arg[1:]
-            target_id = db.get_user_by_username(username)
+            target_id = await db.get_user_by_username(username)
         else:
             try:
                 target_id = int(target_arg)
@@ -1484,11 +3041,8 @@ async def admin_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
 
     if target_id:
-        cursor = db.conn.cursor()
-        cursor.execute(
-            'UPDATE users SET roblox_nickname = NULL, photo_id = NULL, game_modes = NULL, profile_verified = 0 WHERE user_id = ?',
-            (target_id,))
-        db.conn.commit()
+        await db.clear_profile(target_id)
+        card_cache.invalidate(target_id)
 
         await update.message.reply_text(f"✅ Анкета пользователя {target_id} очищена")
 
@@ -1513,7 +3067,7 @@ async def admin_clearpoint(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_arg = context.args[0]
             if target_arg.startswith('@'):
                 username = target_arg[1:]
-                target_id = db.get_user_by_username(username)
+                target_id = await db.get_user_by_username(username)
                 if not target_id:
                     await update.message.reply_text("❌ Пользователь не найден")
                     return
@@ -1525,9 +3079,7 @@ async def admin_clearpoint(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Укажите пользователя")
             return
 
-        cursor = db.conn.cursor()
-        cursor.execute('UPDATE users SET team_balls = 0 WHERE user_id = ?', (target_id,))
-        db.conn.commit()
+        await db.clear_team_balls(target_id)
 
         await update.message.reply_text(f"✅ Тимбалы пользователя {target_id} очищены")
 
@@ -1545,60 +3097,118 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin_or_verifier(update.effective_user.id):
         return
 
-    cursor = db.conn.cursor()
+    stats = await db.get_stats()
+
+    text = "<b>📊 Статистика бота:</b>\n\n"
+    text += f"👥 Всего пользователей: {stats['total_users']}\n"
+    text += f"✅ Верифицировано: {stats['verified_users']}\n"
+    text += f"⏳ На проверке: {stats['pending_users']}\n"
+    text += f"❌ Забанено: {stats['banned_users']}\n"
+    text += f"👍 Всего лайков: {stats['total_likes']}\n"
+    text += f"💰 Всего тимбалов в системе: {stats['total_teamballs']}\n"
+
+    for title, store in (("💬 Диалогов", user_states), ("🃏 Колод поиска", decks)):
+        store_stats = store.stats()
+        text += (f"{title} в памяти: {store_stats['entries']} (~{store_stats['approx_bytes'] // 1024} КБ, "
+                 f"истекло {store_stats['expired']}, вытеснено {store_stats['evicted']})\n")
+    text += f"🖼 Карточек в кэше: {len(card_cache)} (попаданий {card_cache.hits}, промахов {card_cache.misses})\n"
 
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    cursor.execute('SELECT COUNT(*) FROM users WHERE profile_verified = 1')
-    verified_users = cursor.fetchone()[0]
 
-    cursor.execute('SELECT COUNT(*) FROM users WHERE profile_verified = 0 AND roblox_nickname IS NOT NULL')
-    pending_users = cursor.fetchone()[0]
+async def admin_recount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /recount - пересчет счетчиков лайков и рефералов"""
+    if not is_admin(update.effective_user.id):
+        return
 
-    cursor.execute('SELECT COUNT(*) FROM users WHERE is_banned = 1')
-    banned_users = cursor.fetchone()[0]
+    fixed = await db.repair_counters()
+    await update.message.reply_text(f"✅ Счетчики пересчитаны, исправлено пользователей: {fixed}")
 
-    cursor.execute('SELECT COUNT(*) FROM interactions WHERE is_like = 1')
-    total_likes = cursor.fetchone()[0]
 
-    cursor.execute('SELECT SUM(team_balls) FROM users')
-    total_teamballs = cursor.fetchone()[0] or 0
+USER_FILTER_TITLES = {
+    "all": "Все",
+    "banned": "Забанены",
+    "pending": "На проверке",
+    "verified": "Одобрены",
+}
 
-    text = "<b>📊 Статистика бота:</b>\n\n"
-    text += f"👥 Всего пользователей: {total_users}\n"
-    text += f"✅ Верифицировано: {verified_users}\n"
-    text += f"⏳ На проверке: {pending_users}\n"
-    text += f"❌ Забанено: {banned_users}\n"
-    text += f"👍 Всего лайков: {total_likes}\n"
-    text += f"💰 Всего тимбалов в системе: {total_teamballs}\n"
 
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+async def render_users_page(status: str, after_id: Optional[int] = None, before_id: Optional[int] = None):
+    """Собирает текст и кнопки страницы списка пользователей"""
+    users, has_more = await db.get_users_page(status, after_id, before_id, USERS_PAGE_SIZE)
+    stats = await db.get_stats()
+    total = stats.get(Database.USER_FILTERS[status][1], 0)
+
+    text = f"<b>👥 Список пользователей ({USER_FILTER_TITLES[status]}: {total}):</b>\n\n"
+    if not users:
+        text += "📭 Пользователей нет"
+
+    for user in users:
+        user_id, username, roblox_nick, team_balls, is_banned, verified = user
+        status_icon = "❌" if is_banned else ("✅" if verified == 1 else ("⏳" if verified == 0 else "🚫"))
+        text += f"{status_icon} ID: {user_id} | @{username or 'нет'}\n"
+        text += f"   Ник: {roblox_nick or 'нет'} | Тимбалы: {team_balls}\n\n"
+
+    # Назад - если пришли со следующей страницы или перед первой строкой есть еще
+    has_prev = has_more if before_id is not None else after_id is not None
+    has_next = has_more if before_id is None else True
+
+    navigation = []
+    if users and has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"users_{status}_prev_{users[0][0]}"))
+    if users and has_next:
+        navigation.append(InlineKeyboardButton("Далее ➡️", callback_data=f"users_{status}_next_{users[-1][0]}"))
+
+    keyboard = [[
+        InlineKeyboardButton(("• " if name == status else "") + title, callback_data=f"users_{name}_first_0")
+        for name, title in USER_FILTER_TITLES.items()
+    ]]
+    if navigation:
+        keyboard.append(navigation)
+
+    return text, InlineKeyboardMarkup(keyboard)
 
 
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /users для просмотра пользователей"""
+    """Команда /users [banned|pending|verified] для просмотра пользователей"""
     if not is_admin_or_verifier(update.effective_user.id):
         return
 
-    users = db.get_all_users()
-
-    if not users:
-        await update.message.reply_text("📭 Пользователей нет")
+    status = context.args[0].lower() if context.args else "all"
+    if status not in USER_FILTER_TITLES:
+        await update.message.reply_text("❌ Использование: /users [banned|pending|verified]")
         return
 
-    text = "<b>👥 Список пользователей:</b>\n\n"
+    text, reply_markup = await render_users_page(status)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
-    for user in users[:30]:
-        user_id, username, roblox_nick, team_balls, is_banned, verified = user
-        status = "❌" if is_banned else ("✅" if verified == 1 else ("⏳" if verified == 0 else "🚫"))
-        text += f"{status} ID: {user_id} | @{username or 'нет'}\n"
-        text += f"   Ник: {roblox_nick or 'нет'} | Тимбалы: {team_balls}\n\n"
 
-    if len(users) > 30:
-        text += f"\n... и еще {len(users) - 30} пользователей"
+async def admin_users_page(query, context, page: str):
+    """Листание списка пользователей: users_<фильтр>_<first|next|prev>_<user_id>"""
+    if not is_admin_or_verifier(query.from_user.id):
+        return
 
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    try:
+        status, direction, cursor_id = page.split("_")
+        cursor_id = int(cursor_id)
+    except ValueError:
+        return
+    if status not in USER_FILTER_TITLES:
+        return
+
+    if direction == "next":
+        text, reply_markup = await render_users_page(status, after_id=cursor_id)
+    elif direction == "prev":
+        text, reply_markup = await render_users_page(status, before_id=cursor_id)
+    else:
+        text, reply_markup = await render_users_page(status)
+
+    try:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Повторное нажатие на текущий фильтр
+        if "not modified" not in str(e):
+            raise
 
 
 async def admin_verifications(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1606,15 +3216,17 @@ async def admin_verifications(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not is_verifier(update.effective_user.id):
         return
 
-    verifications = db.get_pending_verifications()
+    verifications, available = await db.claim_verifications(
+        update.effective_user.id, VERIFICATION_BATCH_SIZE, VERIFICATION_LEASE_SECONDS)
 
     if not verifications:
         await update.message.reply_text("📭 Нет анкет на проверке")
         return
 
-    text = f"<b>📋 Анкеты на проверке:</b> {len(verifications)}\n\n"
+    text = (f"<b>📋 Ваши анкеты на проверке:</b> {len(verifications)} "
+            f"(закреплены за вами на {VERIFICATION_LEASE_SECONDS // 60} мин.)\n\n")
 
-    for i, (user_id, username, roblox_nick, photo_id, game_modes) in enumerate(verifications[:5], 1):
+    for i, (user_id, username, roblox_nick, photo_id, game_modes) in enumerate(verifications, 1):
         text += f"<b>{i}. @{username or 'нет'}</b>\n"
         text += f"   ID: {user_id}\n"
         text += f"   Ник: {roblox_nick}\n"
@@ -1650,8 +3262,8 @@ async def admin_verifications(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         text = ""
 
-    if len(verifications) > 5:
-        await update.message.reply_text(f"📋 ... и еще {len(verifications) - 5} анкет на проверке")
+    if available:
+        await update.message.reply_text(f"📋 ... и еще {available} свободных анкет в очереди")
 
 
 async def admin_leaders(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1659,15 +3271,17 @@ async def admin_leaders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
 
-    top_users = db.get_top_users_by_teamballs(20)
+    top_users = leaderboard.top(20)
 
     if not top_users:
         await update.message.reply_text("📭 Нет пользователей в рейтинге")
         return
 
+    names = await db.get_users_brief([user_id for user_id, _ in top_users])
     text = "<b>🏆 Топ-20 игроков по тимбалам:</b>\n\n"
 
-    for i, (user_id, username, roblox_nick, team_balls, verified) in enumerate(top_users, 1):
+    for i, (user_id, team_balls) in enumerate(top_users, 1):
+        username, roblox_nick = names.get(user_id, (None, None))
         medal = "🥇" if i == 1 else ("🥈" if i == 2 else ("🥉" if i == 3 else f"{i}."))
         text += f"{medal} <b>@{username or 'нет_username'}</b>\n"
         text += f"   <b>Ник в Roblox:</b> {roblox_nick or 'нет'}\n"
@@ -1677,15 +3291,40 @@ async def admin_leaders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
+async def admin_routestats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /routestats - время обработки inline-кнопок"""
+    if not is_admin(update.effective_user.id):
+        return
+
+    routes = sorted(
+        ((name, stats) for name, stats in router.stats.items() if stats.calls),
+        key=lambda item: item[1].avg_ms,
+        reverse=True
+    )
+
+    if not routes:
+        await update.message.reply_text("📭 Кнопки еще не нажимали")
+        return
+
+    text = "<b>⏱ Время обработки кнопок (по убыванию среднего):</b>\n\n"
+    for name, stats in routes:
+        text += (
+            f"<b>{name}</b>: {stats.calls} выз., ср. {stats.avg_ms:.1f} мс, "
+            f"макс. {stats.max_ms:.1f} мс, ошибок {stats.errors}\n"
+        )
+
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
 # =========== КОМАНДЫ ДЛЯ ВЕРИФИКАТОРОВ ===========
-async def handle_approve_profile(query, context):
+async def handle_approve_profile(query, context, user_id: int):
     """Одобряет анкету"""
     if not is_verifier(query.from_user.id):
         await query.answer("❌ У вас нет прав для этого")
         return
 
-    user_id = int(query.data.split("_")[1])
-    db.approve_profile(user_id)
+    await query.answer()
+    await db.approve_profile(user_id)
 
     await query.edit_message_text(f"✅ Анкета пользователя {user_id} одобрена")
 
@@ -1698,14 +3337,14 @@ async def handle_approve_profile(query, context):
         pass
 
 
-async def handle_reject_profile(query, context):
+async def handle_reject_profile(query, context, user_id: int):
     """Отклоняет анкету"""
     if not is_verifier(query.from_user.id):
         await query.answer("❌ У вас нет прав для этого")
         return
 
-    user_id = int(query.data.split("_")[1])
-    db.reject_profile(user_id)
+    await query.answer()
+    await db.reject_profile(user_id)
 
     await query.edit_message_text(f"❌ Анкета пользователя {user_id} отклонена")
 
@@ -1718,59 +3357,257 @@ async def handle_reject_profile(query, context):
         pass
 
 
-async def handle_admin_reply(query, context):
+async def handle_admin_reply(query, context, user_id: int):
     """Обработчик кнопки ответа на поддержку"""
     if not is_admin_or_verifier(query.from_user.id):
         await query.answer("❌ У вас нет прав для этого")
         return
 
-    user_id = int(query.data.split("_")[1])
+    await query.answer()
     context.user_data["replying_to"] = user_id
 
     await query.message.reply_text(f"💌 Введите ответ для пользователя {user_id}:")
 
 
 # =========== ОБЩИЕ ФУНКЦИИ ===========
-async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cancel_handler(query, context):
     """Обработчик отмены"""
-    query = update.callback_query
-    await query.answer()
+    user_states.pop(query.from_user.id)
+    if "message_for_user" in context.user_data:
+        del context.user_data["message_for_user"]
+
+    await back_to_menu(query, context)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных пользователей параллельно, а одного - строго по порядку
+
+    Апдейт сначала ждет очереди своего пользователя (asyncio.Lock отпускает
+    ожидающих по порядку), и только потом занимает один из max_concurrent
+    слотов, поэтому пачка нажатий одного пользователя не забирает слоты у
+    остальных. Базовый семафор ограничивает число апдейтов в ожидании.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates * 4)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+
+    @staticmethod
+    def _update_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
 
-    user_id = query.from_user.id
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
 
-    if query.data in ["cancel_message", "cancel_support"]:
-        if user_id in user_states:
-            del user_states[user_id]
-        if "message_for_user" in context.user_data:
-            del context.user_data["message_for_user"]
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
 
-        keyboard = [
-            [InlineKeyboardButton("👤 Моя анкета", callback_data="my_profile")],
-            [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="find_teammate")],
-            [InlineKeyboardButton("🤝 Найденные тиммейты", callback_data="found_teammates")],
-            [InlineKeyboardButton("🏪 Магазин", callback_data="shop")],
-            [InlineKeyboardButton("🔗 Реф ссылка", callback_data="referral")],
-            [InlineKeyboardButton("📞 Поддержка", callback_data="support")]
-        ]
+        try:
+            async with lock, self._running:
+                await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    @property
+    def waiting(self) -> int:
+        """Сколько апдейтов ждут или обрабатываются"""
+        return sum(self._waiting.values())
+
+    async def initialize(self) -> None:
+        pass
 
-        await query.edit_message_text(
-            "🎮 <b>Бот для поиска тиммейтов в Roblox</b>\n\n"
-            "Выберите действие:",
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        await query.message.reply_text(
-            "Ты можешь всегда нажать на кнопку '🏠 В меню' чтобы вернуться сюда",
-            reply_markup=get_menu_keyboard()
+    async def shutdown(self) -> None:
+        pass
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает запросы к Bot API по методу и результату
+
+    Результат - HTTP-код ответа или имя исключения, если ответа не было.
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_requests_total", method=api_method, outcome=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - started, method=api_method)
+
+        metrics.inc("bot_api_requests_total", method=api_method, outcome=str(code))
+        return code, payload
+
+
+def timed_handler(callback):
+    """Оборачивает обработчик PTB замером времени и счетчиком ошибок"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP-ответ на GET /metrics"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки не нужны, просто дочитываем их до пустой строки
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
         )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
 
-def main():
-    """Запуск бота"""
-    application = Application.builder().token(TOKEN).build()
+def reload_leaderboard(database: Database):
+    """Перечитывает рейтинг из базы, вызывается через db.run_write
+
+    В потоке писателя снимок упорядочен с вызовами leaderboard.update из
+    триггера: изменение баланса не может закоммититься между чтением строк
+    и load() и потеряться до следующей сверки.
+    """
+    leaderboard.load(database.get_leaderboard_rows())
+
+
+async def reconcile_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически исправляет расхождения итогов /stats и рейтинга с таблицами"""
+    drift = await db.reconcile_stats()
+    for name, (was, actual) in drift.items():
+        logger.warning("Итог %s расходился с таблицами: %s -> %s", name, was, actual)
+
+    # Рейтинг мог разойтись с базой, если транзакция с изменением баланса откатилась
+    await db.run_write(reload_leaderboard)
+
+
+async def post_init(application: Application):
+    """Восстанавливает незавершенные диалоги и запускает фоновые задачи"""
+    if STATE_PERSIST:
+        user_states.load(await db.load_user_states(int(time.time())))
+        logger.info("Восстановлено состояний диалогов: %d", len(user_states))
+
+    # Сначала подписываемся на изменения балансов, потом читаем рейтинг
+    await db.run_write(Database.watch_balances, leaderboard.update)
+    await db.run_write(reload_leaderboard)
+    logger.info("Рейтинг загружен: %d участников", len(leaderboard))
+
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            reconcile_stats_job, interval=STATS_RECONCILE_INTERVAL, first=STATS_RECONCILE_INTERVAL)
+    else:
+        logger.warning("JobQueue недоступен (нет APScheduler), итоги /stats не сверяются")
+
+    if METRICS_PORT:
+        try:
+            application.bot_data["metrics_server"] = await asyncio.start_server(
+                serve_metrics, METRICS_HOST, METRICS_PORT)
+            logger.info("Метрики: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error("Не удалось запустить сервер метрик: %s", e)
+
+
+async def post_shutdown(application: Application):
+    """Останавливает сервер метрик и закрывает базу данных"""
+    server = application.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+        await server.wait_closed()
+    await db.aclose()
+
+
+# Датчики очередей и кэшей для /metrics
+metrics.gauge("bot_db_pending_writes", "Свайпы в очереди отложенной записи", lambda: db.pending_writes)
+metrics.gauge("bot_db_writes_in_flight", "Записи, ожидающие или выполняющиеся в потоке писателя",
+              lambda: db.writes_in_flight)
+metrics.gauge("bot_notify_tasks", "Незавершенные рассылки админам и верификаторам", lambda: len(notify_tasks))
+metrics.gauge("bot_user_states", "Незавершенные диалоги в памяти", lambda: len(user_states))
+metrics.gauge("bot_decks", "Колоды поиска в памяти", lambda: len(decks))
+metrics.gauge("bot_card_cache_entries", "Карточки в кэше", lambda: len(card_cache))
+metrics.gauge("bot_leaderboard_size", "Участники рейтинга", lambda: len(leaderboard))
+
+# Таблица маршрутов inline-кнопок
+router = CallbackRouter()
+router.exact("my_profile", show_my_profile)
+router.exact("edit_profile", edit_profile)
+router.exact("find_teammate", find_teammate)
+router.exact("found_teammates", show_found_teammates)
+router.exact("shop", show_shop)
+router.exact("referral", show_referral_link)
+router.exact("support", ask_support_message)
+router.exact("back_to_menu", back_to_menu)
+router.exact("cancel_message", cancel_handler)
+router.exact("cancel_support", cancel_handler)
+router.prefix("like_", handle_like, int, answers=True)
+router.prefix("dislike_", handle_dislike, int, answers=True)
+router.prefix("buy_", handle_purchase, str, answers=True)
+router.prefix("approve_", handle_approve_profile, int, answers=True)
+router.prefix("reject_", handle_reject_profile, int, answers=True)
+router.prefix("reply_", handle_admin_reply, int, answers=True)
+router.prefix("users_", admin_users_page, str)
+
+
+def build_application(token: str = TOKEN, request=None) -> Application:
+    """Создает приложение со всеми обработчиками
+
+    request - свой слой запросов к Bot API (например, заглушка для нагрузочных тестов).
+    """
+    processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    application = (
+        Application.builder()
+        .token(token)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(processor)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    metrics.gauge("bot_updates_waiting", "Апдейты в очереди своего пользователя", lambda: processor.waiting)
 
     # Команды пользователей
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("top", top_command))
 
     # Команды админов
     application.add_handler(CommandHandler("give", admin_give))
@@ -1780,25 +3617,34 @@ def main():
     application.add_handler(CommandHandler("clear", admin_clear))
     application.add_handler(CommandHandler("clearpoint", admin_clearpoint))
     application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("recount", admin_recount))
     application.add_handler(CommandHandler("users", admin_users))
     application.add_handler(CommandHandler("leaders", admin_leaders))
+    application.add_handler(CommandHandler("routestats", admin_routestats))
 
     # Команды верификаторов
     application.add_handler(CommandHandler("verifications", admin_verifications))
 
     # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(CallbackQueryHandler(handle_like, pattern="^like_"))
-    application.add_handler(CallbackQueryHandler(handle_dislike, pattern="^dislike_"))
-    application.add_handler(CallbackQueryHandler(handle_purchase, pattern="^buy_"))
-    application.add_handler(CallbackQueryHandler(handle_approve_profile, pattern="^approve_"))
-    application.add_handler(CallbackQueryHandler(handle_reject_profile, pattern="^reject_"))
-    application.add_handler(CallbackQueryHandler(handle_admin_reply, pattern="^reply_"))
+    application.add_handler(CallbackQueryHandler(router.dispatch))
 
     # Обработчики сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     application.add_handler(MessageHandler(filters.PHOTO, photo_handler))
 
+    # Кнопки замеряет сам router - по маршрутам
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if handler.callback != router.dispatch:
+                handler.callback = timed_handler(handler.callback)
+
+    return application
+
+
+def main():
+    """Запуск бота"""
+    application = build_application()
+
     # Запуск
     logger.info("Бот запускается...")
     print("Бот запускается...")
@@ -1806,7 +3652,18 @@ def main():
     print(f"Верификаторы: {VERIFIER_IDS}")
     print(f"Админы+Верификаторы: {ADMIN_AND_VERIFIER_IDS}")
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        print(f"Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':